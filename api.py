@@ -1,16 +1,38 @@
 """Backend server of Ladders, exposing a JSON api."""
+import argparse
+import array
 import collections
+import hashlib
+import itertools
 import logging
+import multiprocessing
 import os
 import sqlite3
+import sys
+import time
 import zlib
-from typing import Any, DefaultDict, Iterable, List
+from typing import (Any, Callable, DefaultDict, Iterable, List, Optional,
+                    Tuple)
 
 import flask  # type:ignore
-import oauth2client.client
+import numpy
 import oauth2client.crypt
-
+import trueskill
+
+import compaction
+import database
+import downsample
+import export
+import ingest
+import matchmaking
+import metrics
+import migrations
+from caching import LRUCache
+from identity import IdentityVerifier
+from leaderboard import Leaderboard
 from ranking import Ranking
+from submissions import Created, SubmissionQueue
+from suggest import SuggestionIndex
 
 app = flask.Flask(__name__)  # pylint: disable=invalid-name
 
@@ -18,6 +40,18 @@ ACCEPTED_OAUTH_CLIENTS = (
     # The web frontend:
     '151187347955-v66j53n6mavb5mahpaq77q4k8fk1g588.apps.googleusercontent.com',
 )
+ACCEPTED_OAUTH_ISSUERS = ('accounts.google.com', 'https://accounts.google.com')
+
+IDENTITIES = IdentityVerifier(ACCEPTED_OAUTH_CLIENTS, ACCEPTED_OAUTH_ISSUERS)
+# Serialized bodies of the polled endpoints, keyed by the ladder's version,
+# at most 64 MB of them per worker.
+RESPONSES = LRUCache(1024, max_size=64 * 1024 * 1024)
+# How a cached response is serialized, and its mimetype.
+Format = Tuple[Callable[[Any], Any], str]
+JSON_FORMAT: Format = (flask.json.dumps, 'application/json')
+SUGGESTIONS = SuggestionIndex()
+# Largest pool of players accepted by matchmake.
+MATCHMAKING_POOL = 1000
 
 
 @app.route('/api/<ladder>/create', methods=['POST'])
@@ -58,9 +92,9 @@ def settings(ladder: str) -> flask.Response:
         flask.abort(401)
     cursor = flask.g.dbh.cursor()
     with flask.g.dbh:
-        cursor.execute('update ladders set mu=?, sigma=?, tau=?, '
+        cursor.execute('update ladders set mu=?, sigma=?, beta=?, tau=?, '
                        'teams_count=?, players_per_team=?, '
-                       'draw_probability=?, last_ranking=? where name =?',
+                       'draw_probability=? where name =?',
                        [
                            req.json.get('mu', 1200),
                            req.json.get('sigma', 400),
@@ -69,16 +103,11 @@ def settings(ladder: str) -> flask.Response:
                            req.json.get('teams_count', 2),
                            req.json.get('players_per_team', 1),
                            req.json.get('draw_probability', 0),
-                           0,
                            req.json['name']
                        ])
-        cursor.execute(
-            'update players set mu=?, sigma=? where ladder=?',
-            [
-                req.json.get('mu', 1200),
-                req.json.get('sigma', 400),
-                ladder
-            ])
+        Ranking(ladder, flask.g.dbh).reset()
+        bump_version(cursor, ladder)
+    update_ranking(ladder)
     return flask.jsonify({'result': 'ok'}), 201
 
 
@@ -87,46 +116,115 @@ def get_settings(ladder: str) -> flask.Response:
     """Get settings of a ladder."""
     if not ladder_exists(ladder):
         return flask.jsonify({'exists': False})
-    cursor = flask.g.dbh.cursor()
-    cursor.execute('select * from ladders where name=?', [ladder])
-    return flask.jsonify({'exists': True, 'settings': dict(cursor.fetchone())})
+
+    def build() -> Any:
+        cursor = flask.g.dbh.cursor()
+        cursor.execute('select * from ladders where name=?', [ladder])
+        return {'exists': True, 'settings': dict(cursor.fetchone())}
+    return cached(ladder, 'settings', (), build)
 
 
 @app.route('/api/<ladder>/game', methods=['POST'])
 def submit(ladder: str) -> flask.Response:
-    """Submit game results."""
+    """Submit game results.
+
+    With group commit enabled, the game is written by the queue along with
+    others submitted at about the same time.
+    """
     if not require(['outcome']):
         flask.abort(400)
-    cursor = flask.g.dbh.cursor()
-    cursor.execute('select mu, sigma, tau, draw_probability '
-                   'from ladders where name=?', [ladder])
-    conf = cursor.fetchone()
+    try:
+        outcome = [[member['name'] for member in members]
+                   for members in flask.request.json['outcome']]
+    except (TypeError, KeyError):
+        flask.abort(400)
+    names = [name for members in outcome for name in members]
+    if not all(isinstance(name, str) and name for name in names) or len(
+            set(names)) != len(names):
+        flask.abort(400)
+    # A game needs at least two tiers to be rated.
+    if len([members for members in outcome if members]) < 2:
+        flask.abort(400)
+    if not ladder_exists(ladder):
+        return flask.jsonify({'exists': False})
     try:
         uid = get_uid()
     except oauth2client.crypt.AppIdentityError:
         uid = None
+    if SUBMISSIONS is not None:
+        game = SUBMISSIONS.submit(ladder, outcome, uid,
+                                  flask.request.remote_addr)
+        return flask.jsonify({'result': 'ok', 'id': game}), 201
+    cursor = flask.g.dbh.cursor()
+    created, roster_version = [], 0
     with flask.g.dbh:  # Automatically commit/rollback.
-        cursor.execute('insert into games (ladder, reporter_uid, reporter_ip) '
-                       'values (?,?,?)', [ladder, uid, flask.request.remote_addr])
-        game = cursor.lastrowid
-        print('Outcome:')
-        for position, members in enumerate(flask.request.json['outcome']):
-            print('Tier %d members: %s' % (position, members))
-            for member in members:
-                name = member['name']
-                if not name:
-                    flask.abort(400)
-                cursor.execute('select count(*) from players where name=?'
-                               ' and ladder=?', [name, ladder])
-                if cursor.fetchone()[0] == 0:
-                    cursor.execute(
-                        'insert into players (name, ladder, mu, sigma) '
-                        'values (?,?,?,?)',
-                        [name, ladder, conf['mu'], conf['sigma']])
+        game = database.allocate_game_ids(cursor)
+        cursor.execute('insert into games (id, ladder, reporter_uid, '
+                       'reporter_ip) values (?,?,?,?)',
+                       [game, ladder, uid, flask.request.remote_addr])
+        for position, members in enumerate(outcome):
+            logging.debug('Game %d tier %d members: %s', game, position, members)
+            for name in members:
+                cursor.execute('insert or ignore into players '
+                               '(name, ladder, mu, sigma) '
+                               'select ?, name, mu, sigma '
+                               'from ladders where name=?', [name, ladder])
+                if cursor.rowcount:
+                    created.append(name)
                 cursor.execute(
                     'insert into participants (game, player, position) '
                     'values (?, ?, ?)', [game, name, position])
-    return flask.jsonify({'result': 'ok'}), 201
+        bump_version(cursor, ladder)
+        if created:
+            roster_version = bump_roster_version(cursor, ladder)
+    if created:
+        SUGGESTIONS.added(ladder, created, roster_version)
+    update_ranking(ladder)
+    return flask.jsonify({'result': 'ok', 'id': game}), 201
+
+
+def games_committed(dbh: sqlite3.Connection, created: Created) -> None:
+    """Update suggestions and rankings after the queue wrote some games."""
+    for ladder, (names, roster_version) in created.items():
+        if names:
+            SUGGESTIONS.added(ladder, names, roster_version)
+        update_ranking(ladder, dbh)
+
+
+# Writes the submitted games in batches, if group commit is enabled.
+SUBMISSIONS = (SubmissionQueue(games_committed)
+               if os.environ.get('LADDERS_GROUP_COMMIT') else None)
+
+
+@app.route('/api/<ladder>/games', methods=['POST'])
+def submit_many(ladder: str) -> flask.Response:
+    """Import many games at once, e.g. from a past season.
+
+    The body is streamed as JSON lines, or as CSV rows if the content type
+    is text/csv; see the ingest module for the formats. It is not a json
+    object, so the owner's token goes to the `Authorization: Bearer` header.
+    Games must be in the order of their timestamps and not older than the
+    ladder's games, see `ingest.import_games`.
+    """
+    if not owned(ladder):
+        flask.abort(401)
+    if flask.request.mimetype == 'text/csv':
+        parse = ingest.parse_csv
+    else:
+        parse = ingest.parse_jsonl
+    body = ingest.spool(flask.request.stream)
+    try:
+        ingest.check_games(parse(ingest.read_lines(body)))
+        count = ingest.import_games(flask.g.dbh, ladder,
+                                    parse(ingest.read_lines(body)), get_uid(),
+                                    flask.request.remote_addr)
+    except (ValueError, sqlite3.IntegrityError) as exception:
+        logging.info('Rejected import: %s', exception)
+        flask.abort(400)
+    finally:
+        body.close()
+    update_ranking(ladder)
+    return flask.jsonify({'result': 'ok', 'games': count}), 201
 
 
 @app.route('/api/<ladder>/remove', methods=['POST'])
@@ -146,77 +244,324 @@ def remove(ladder: str) -> flask.Response:
                          "(id %d is %s in request %s in database).",
                          gid, ladder, row['game'])
             flask.abort(401)
+        # Only the games after the preceding checkpoint need to be replayed.
+        Ranking(ladder, flask.g.dbh).rewind(gid)
+        cursor.execute('select player from participants where game = ?',
+                       [gid])
+        players = [(row[0], ladder) for row in cursor.fetchall()]
         cursor.execute('delete from games where id = ?', [gid])
         cursor.execute('delete from participants where game = ?', [gid])
-        cursor.execute('update ladders set last_ranking = 0 where name = ?',
-                       [ladder])
-        cursor.execute('delete from history where ladder = ?', [ladder])
-        cursor.execute('delete from players where ladder = ? '
-                       'and name not in '
-                       '(select player from participants where ladder=?)',
-                       [ladder, ladder])
-        cursor.execute('select mu, sigma from ladders where name = ?',
-                       [ladder])
-        conf = cursor.fetchone()
-        cursor.execute('update players set mu=?, sigma=?, games_count=0, '
-                       'wins_count=0 where ladder = ?',
-                       [conf['mu'], conf['sigma'], ladder])
+        # Cross join looks the player's games up first, not the ladder's.
+        cursor.executemany('delete from players where name = ? '
+                           'and ladder = ? and not exists '
+                           '(select 1 from participants cross join games '
+                           'on games.id = participants.game '
+                           'where participants.player = players.name '
+                           'and games.ladder = players.ladder)', players)
+        if cursor.rowcount > 0:
+            bump_roster_version(cursor, ladder)
+        bump_version(cursor, ladder)
+    update_ranking(ladder)
     return flask.jsonify()
 
 
 @app.route('/api/<ladder>/ranking', methods=['GET'])
 def ranking(ladder: str) -> flask.Response:
-    """Get the players ranked by their skill."""
+    """Get the players ranked by their skill.
+
+    Ratings are updated when games are submitted or removed. Games left
+    pending, for example by a failed update, are rated here first.
+
+    Optional query parameters:
+      limit, offset: return just a page of the players.
+      order: `conservative` to rank by mu - 3 * sigma.
+    """
     if not ladder_exists(ladder):
         return flask.jsonify({'exists': False})
+    args = flask.request.args
+    try:
+        limit = int(args.get('limit', -1))
+        offset = int(args.get('offset', 0))
+    except ValueError:
+        flask.abort(400)
+    conservative = conservative_order()
+    update_ranking(ladder)
     rnk = Ranking(ladder, flask.g.dbh)
-    rnk.recalculate()
-    result = {
+    return cached(ladder, 'ranking', (limit, offset, conservative), lambda: {
         'exists': True,
-        'ranking': [dict(player) for player in rnk.standings()]
-    }
-    return flask.jsonify(result)
+        'ranking': [dict(player) for player in
+                    rnk.standings(conservative, limit, offset)]
+    })
+
+
+@app.route('/api/<ladder>/player/<name>', methods=['GET'])
+def player_position(ladder: str, name: str) -> flask.Response:
+    """Return the rank and percentile of a player, and the players around.
+
+    Optional query parameters:
+      neighbours: how many players above and below to return, 2 by default.
+      order: `conservative` to rank by mu - 3 * sigma.
+    """
+    if not ladder_exists(ladder):
+        return flask.jsonify({'exists': False})
+    try:
+        count = int(flask.request.args.get('neighbours', 2))
+    except ValueError:
+        flask.abort(400)
+    if not 0 <= count <= 100:
+        flask.abort(400)
+    conservative = conservative_order()
+    update_ranking(ladder)
+
+    def build() -> Any:
+        board = Leaderboard(flask.g.dbh, ladder, conservative)
+        player = board.player(name)
+        if player is None:
+            return {'exists': True, 'player': None}
+        above, below = board.neighbours(name, count)
+        return {'exists': True,
+                'player': player,
+                'rank': board.rank(name),
+                'percentile': board.percentile(name),
+                'players_count': len(board),
+                'above': above,
+                'below': below}
+    return cached(ladder, 'player', (name, count, conservative), build)
+
+
+def conservative_order() -> bool:
+    """Parse the `order` query parameter, true for the conservative skill."""
+    order = flask.request.args.get('order', 'mu')
+    if order not in ('mu', 'conservative'):
+        flask.abort(400)
+    return order == 'conservative'
+
+
+def update_ranking(ladder: str,
+                   dbh: Optional[sqlite3.Connection] = None) -> None:
+    """Apply rating updates of all the games not processed yet.
+
+    Called after the games are committed, so a failure must not fail the
+    request. The games stay pending for the next recalculation.
+    """
+    try:
+        Ranking(ladder, dbh or flask.g.dbh).recalculate()
+    except sqlite3.OperationalError as exception:
+        if 'locked' not in str(exception):
+            logging.exception('Ranking of %s not updated.', ladder)
+            return
+        # Another worker holds the ladder for too long.
+        logging.warning('Ranking of %s not updated: %s', ladder, exception)
+    except Exception:  # pylint: disable=broad-except
+        logging.exception('Ranking of %s not updated.', ladder)
+
+
+def bump_version(cursor: sqlite3.Cursor, ladder: str) -> None:
+    """Mark that data of the ladder changed, invalidating cached responses."""
+    cursor.execute('update ladders set version = version + 1 where name = ?',
+                   [ladder])
+
+
+def bump_roster_version(cursor: sqlite3.Cursor, ladder: str) -> int:
+    """Mark that players were created or removed, return the old version."""
+    cursor.execute('select roster_version from ladders where name = ?',
+                   [ladder])
+    roster_version = cursor.fetchone()[0]
+    cursor.execute('update ladders set roster_version = roster_version + 1 '
+                   'where name = ?', [ladder])
+    return roster_version
+
+
+def cached(ladder: str, endpoint: str, params: Tuple,
+           build: Callable[[], Any],
+           response_format: Format = JSON_FORMAT) -> flask.Response:
+    """Serve a response built from data of the ladder, json by default.
+
+    The ETag is derived from the ladder's version, which changes with every
+    write, so a client polling an unchanged ladder just gets 304. Otherwise
+    the serialized body is reused from the cache, or built and cached.
+    """
+    serialize, mimetype = response_format
+    row = flask.g.dbh.execute('select version from ladders where name = ?',
+                              [ladder]).fetchone()
+    if row is None:
+        return flask.Response(serialize(build()), mimetype=mimetype)
+    key = (ladder, endpoint, params, row['version'])
+    etag = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:20]
+    if etag in flask.request.if_none_match:
+        response = flask.Response(status=304)
+    else:
+        body = RESPONSES.get(key)
+        if body is None:
+            body = serialize(build())
+            RESPONSES.put(key, body)
+        response = flask.Response(body, mimetype=mimetype)
+    response.set_etag(etag)
+    return response
 
 
 @app.route('/api/<ladder>/matches', methods=['GET', 'POST'])
 @app.route('/api/<ladder>/matches/<count>', methods=['GET', 'POST'])
 @app.route('/api/<ladder>/matches/<count>/<offset>', methods=['GET', 'POST'])
 def matches(ladder: str, count=42, offset=0) -> flask.Response:
-    """Get the most recent matches."""
+    """Get the most recent matches.
+
+    Pass the `cursor` of the previous page as `after` (query parameter or
+    json field) to get the next one. The `offset` is only kept for old
+    clients, as the database has to skip all the preceding rows.
+    """
     if not ladder_exists(ladder):
         return flask.jsonify({'exists': False})
-    cursor = flask.g.dbh.cursor()
-    cursor.execute('select id, timestamp, reporter_uid, reporter_ip from games where ladder = ? '
-                   'order by timestamp desc limit ? offset ?',
-                   [ladder, count, offset])
+    try:
+        count, offset = int(count), int(offset)
+        after = parse_cursor(request_param('after'))
+    except ValueError:
+        flask.abort(400)
+    if count <= 0 or offset < 0:
+        flask.abort(400)
+    is_owner = owned(ladder)
+    return cached(ladder, 'matches', (count, offset, after, is_owner),
+                  lambda: matches_page(ladder, count, offset, after, is_owner))
+
+
+def matches_page(ladder: str, count: int, offset: int,
+                 after: Optional[Tuple[int, int]], is_owner: bool) -> Any:
+    """Build a page of matches, with reporters only shown to the owner."""
     result = []
-    for game in cursor.fetchall():
-        gid, timestamp, reporter_uid, reporter_ip = game
-        if owned(ladder):
+    for (gid, timestamp, reporter_uid, reporter_ip), rows in itertools.groupby(
+            match_rows(ladder, count, offset, after),
+            key=lambda row: tuple(row[:4])):
+        if is_owner:
             reporter = anonymize(reporter_uid, reporter_ip)
         else:
             reporter = None
         outcome: DefaultDict[int, List[str]] = collections.defaultdict(list)
-        cursor.execute('select position, player from participants '
-                       'where game = ?', [gid])
-        for entry in cursor.fetchall():
-            outcome[entry[0]].append(entry[1])
+        for row in rows:
+            if row['player'] is not None:
+                outcome[row['position']].append(row['player'])
         result.append({'timestamp': timestamp,
                        'id': gid,
                        'reporter': reporter,
                        'outcome': [outcome[i]
                                    for i in sorted(outcome.keys())]})
-    return flask.jsonify({'exists': True, 'matches': result})
+    next_cursor = None
+    if result and len(result) == count:
+        next_cursor = '.'.join([str(result[-1]['timestamp']),
+                                str(result[-1]['id'])])
+    return {'exists': True, 'matches': result, 'cursor': next_cursor}
+
+
+def match_rows(ladder: str, count: int, offset: int,
+               after: Optional[Tuple[int, int]]) -> sqlite3.Cursor:
+    """Query a page of games, a row for each of their participants."""
+    if after is None:
+        keyset, params = '', [ladder, count, offset]
+    else:
+        # Written so that games_by_time bounds the scan by the timestamp.
+        keyset = 'and timestamp <= ? and (timestamp < ? or id < ?) '
+        params = [ladder, after[0], after[0], after[1], count, offset]
+    return flask.g.dbh.execute(
+        'select page.id, page.timestamp, page.reporter_uid, '
+        'page.reporter_ip, participants.position, participants.player from '
+        '(select id, timestamp, reporter_uid, reporter_ip '
+        'from games where ladder = ? ' + keyset +
+        'order by timestamp desc, id desc limit ? offset ?) '
+        'as page left join participants on participants.game = page.id '
+        'order by page.timestamp desc, page.id desc, participants.position',
+        params)
+
+
+def parse_cursor(token: Optional[str]) -> Optional[Tuple[int, int]]:
+    """Parse a `timestamp.id` pagination cursor, raise ValueError if bad."""
+    if token is None:
+        return None
+    timestamp, gid = str(token).split('.')
+    return int(timestamp), int(gid)
 
 
 @app.route('/api/<ladder>/history/<player>', methods=['GET'])
 def history(ladder: str, player: str) -> flask.Response:
-    """Return a list of (timestamp, mu) pairs."""
-    cursor = flask.g.dbh.cursor()
-    cursor.execute('select timestamp, mu from history '
-                   'where ladder=? and player=? order by timestamp asc',
-                   [ladder, player])
-    return flask.jsonify([(row[0], row[1]) for row in cursor.fetchall()])
+    """Return a list of (timestamp, mu) pairs.
+
+    Recent points are read from the history rows, older ones from the
+    compacted archive.
+
+    Optional query parameters:
+      from, to: limit the time range, both inclusive.
+      points: downsample to about this many points.
+      format: `columns` for a json object of parallel timestamp, mu and sigma
+        arrays; `binary` for the same as packed little-endian doubles, all
+        timestamps followed by all mus and all sigmas.
+    """
+    args = flask.request.args
+    try:
+        since = int(args.get('from', 0))
+        until = int(args.get('to', 2 ** 63 - 1))
+        points = int(args['points']) if 'points' in args else None
+    except ValueError:
+        flask.abort(400)
+    if points is not None and points < 2:
+        flask.abort(400)
+    fmt = args.get('format', 'pairs')
+    if fmt not in ('pairs', 'columns', 'binary'):
+        flask.abort(400)
+
+    def build() -> Any:
+        cursor = flask.g.dbh.cursor()
+        cursor.execute('select timestamp, mu, sigma, game from history '
+                       'where ladder=? and player=? '
+                       'and timestamp>=? and timestamp<=? '
+                       'order by timestamp, game',
+                       [ladder, player, since, until])
+        rows = cursor.fetchall()
+        archived = compaction.archived(flask.g.dbh, ladder, player, since)
+        older = [point for point in archived if since <= point[0] <= until]
+        if older:
+            rows = compaction.merge(older, [tuple(row) for row in rows])
+        if points is not None:
+            picked = downsample.lttb([row[0] for row in rows],
+                                     [row[1] for row in rows], points)
+            rows = [rows[i] for i in picked]
+        if fmt == 'pairs':
+            return [(row[0], row[1]) for row in rows]
+        return {'timestamp': [row[0] for row in rows],
+                'mu': [row[1] for row in rows],
+                'sigma': [row[2] for row in rows]}
+    params = (player, since, until, points, fmt)
+    if fmt == 'binary':
+        return cached(ladder, 'history', params, build,
+                      (pack_columns, 'application/octet-stream'))
+    return cached(ladder, 'history', params, build)
+
+
+def pack_columns(columns: Any) -> bytes:
+    """Pack the history columns as little-endian doubles."""
+    packed = array.array('d', columns['timestamp'])
+    packed.extend(columns['mu'])
+    packed.extend(float('nan') if sigma is None else sigma
+                  for sigma in columns['sigma'])
+    if sys.byteorder == 'big':
+        packed.byteswap()
+    return packed.tobytes()
+
+
+@app.route('/api/<ladder>/export', methods=['GET'])
+def export_endpoint(ladder: str) -> flask.Response:
+    """Stream the games with their ratings as JSON lines.
+
+    Incremental exports pass the id of the last game already exported as
+    `since`.
+    """
+    if not ladder_exists(ladder):
+        return flask.jsonify({'exists': False})
+    try:
+        since = int(request_param('since') or 0)
+    except ValueError:
+        flask.abort(400)
+    return flask.Response(
+        flask.stream_with_context(
+            export.export_lines(flask.g.dbh, ladder, since)),
+        mimetype='application/x-ndjson')
 
 
 def anonymize(user_uid: str, user_ip: str) -> str:
@@ -278,18 +623,79 @@ def match_shape(ladder: str) -> flask.Response:
                           'players_per_team': shape['players_per_team'],
                          })
 
+
+@app.route('/api/<ladder>/matchmake', methods=['GET', 'POST'])
+def matchmake(ladder: str) -> flask.Response:
+    """Propose balanced games among the given pool of players.
+
+    The pool is a list of names, or a comma separated string of them. Team
+    shape defaults to the ladder's. Players not known yet are rated with the
+    ladder's defaults.
+    """
+    if not ladder_exists(ladder):
+        return flask.jsonify({'exists': False})
+    pool = request_param('players') or []
+    if isinstance(pool, str):
+        pool = pool.split(',')
+    if not isinstance(pool, list) or not all(
+            isinstance(name, str) and name for name in pool):
+        flask.abort(400)
+    pool = list(collections.OrderedDict.fromkeys(pool))
+    if len(pool) > MATCHMAKING_POOL:
+        flask.abort(400)
+    cursor = flask.g.dbh.cursor()
+    cursor.execute('select mu, sigma, beta, tau, draw_probability, '
+                   'teams_count, players_per_team from ladders where name=?',
+                   [ladder])
+    conf = cursor.fetchone()
+    try:
+        teams_count = int(request_param('teams_count') or conf['teams_count'])
+        players_per_team = int(request_param('players_per_team') or
+                               conf['players_per_team'])
+    except ValueError:
+        flask.abort(400)
+    if teams_count < 2 or players_per_team < 1:
+        flask.abort(400)
+    tsh = trueskill.TrueSkill(mu=conf['mu'], sigma=conf['sigma'],
+                              beta=conf['beta'], tau=conf['tau'],
+                              draw_probability=conf['draw_probability'])
+    cursor.execute('select name, mu, sigma from players where ladder=?',
+                   [ladder])
+    ratings = {row['name']: (row['mu'], row['sigma']) for row in cursor}
+    mu, sigma = numpy.array([ratings.get(name, (conf['mu'], conf['sigma']))
+                             for name in pool], dtype=float).reshape(-1, 2).T
+    found, unmatched = matchmaking.matchmake(tsh, mu, sigma, teams_count,
+                                             players_per_team)
+    return flask.jsonify({
+        'exists': True,
+        'matches': [{'teams': [[pool[i] for i in team] for team in match.teams],
+                     'quality': match.quality} for match in found],
+        'unmatched': [pool[i] for i in unmatched],
+    })
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics_endpoint() -> flask.Response:
+    """Return the metrics of this worker in the Prometheus text format."""
+    if not metrics.ENABLED:
+        flask.abort(404)
+    return flask.Response(metrics.REGISTRY.render(),
+                          mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/api/<ladder>/suggest_players/', methods=['GET'])
 @app.route('/api/<ladder>/suggest_players/<prefix>', methods=['GET'])
 def suggest_players(ladder: str, prefix: str = "") -> flask.Response:
-    """Suggest a bunch of players with names starting with given prefix."""
-    if not ladder_exists(ladder):
+    """Suggest a bunch of players with names starting with given prefix.
+
+    The most active players come first.
+    """
+    row = flask.g.dbh.execute('select roster_version from ladders '
+                              'where name = ?', [ladder]).fetchone()
+    if row is None:
         return flask.jsonify({'exists': False})
-    cursor = flask.g.dbh.cursor()
-    cursor.execute(
-        'select name from players where ladder=? and name like ? limit 10',
-        [ladder, prefix + "%"])
+    names = SUGGESTIONS.suggest(flask.g.dbh, ladder, row[0], prefix)
     return flask.jsonify({'exists': True,
-                          'names': [row[0] for row in cursor.fetchall()],
+                          'names': names,
                          })
 
 
@@ -297,8 +703,9 @@ def suggest_players(ladder: str, prefix: str = "") -> flask.Response:
 @app.before_request
 def before_request() -> None:
     """Hook to set up SQLite connection."""
-    flask.g.dbh = sqlite3.connect('ladders.db')
-    flask.g.dbh.row_factory = sqlite3.Row
+    if metrics.ENABLED:
+        flask.g.started = time.perf_counter()
+    flask.g.dbh = database.connection()
 
 
 @app.after_request
@@ -309,26 +716,45 @@ def allow_cross_domain(response: flask.Response):
     return response
 
 
+@app.after_request
+def record_request(response: flask.Response):
+    """Hook to record the latency of the request."""
+    if metrics.ENABLED and 'started' in flask.g:
+        metrics.observe('ladders_requests_seconds',
+                        time.perf_counter() - flask.g.started,
+                        endpoint=flask.request.endpoint or 'unknown',
+                        method=flask.request.method,
+                        status=response.status_code)
+    return response
+
+
 @app.teardown_request
 def teardown_request(_exception: Any) -> None:
-    """Hook to close the SQLite connection."""
-    flask.g.dbh.close()
+    """Hook to release the SQLite connection, which is kept open."""
+    database.release(flask.g.dbh)
 
 
 def get_uid() -> str:
     """Extract user id from token received by POST."""
     if 'INTEGRATION_TEST' in os.environ:
         return "dummy_test_uid"
-    if not 'idtoken' in flask.request.json:
-        raise oauth2client.crypt.AppIdentityError('No OAauth2 token.')
-    token = flask.request.json['idtoken']
-    idinfo = oauth2client.client.verify_id_token(token, None)
-    if idinfo['aud'] not in ACCEPTED_OAUTH_CLIENTS:
-        raise oauth2client.crypt.AppIdentityError('Unrecognized client.')
-    if idinfo['iss'] not in ['accounts.google.com',
-                             'https://accounts.google.com']:
-        raise oauth2client.crypt.AppIdentityError('Wrong issuer.')
-    return idinfo['sub']
+    with metrics.timed('ladders_auth_seconds'):
+        authorization = flask.request.headers.get('Authorization', '')
+        if authorization.startswith('Bearer '):
+            return IDENTITIES.verify(authorization[len('Bearer '):])
+        if not 'idtoken' in flask.request.json:
+            raise oauth2client.crypt.AppIdentityError('No OAauth2 token.')
+        return IDENTITIES.verify(flask.request.json['idtoken'])
+
+
+def request_param(name: str) -> Any:
+    """Get a parameter from the query string or the json body."""
+    if name in flask.request.args:
+        return flask.request.args[name]
+    body = flask.request.get_json(silent=True)
+    if isinstance(body, dict):
+        return body.get(name)
+    return None
 
 
 def require(fields: Iterable[str]) -> bool:
@@ -351,19 +777,170 @@ def ladder_exists(ladder: str) -> bool:
 def main():
     """Main, a separate function for scoping."""
     logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    if args.command == 'import':
+        import_file(args.ladder, args.file, args.format)
+    elif args.command == 'compact':
+        compact(args.ladder, args.older_than, args.points, args.vacuum)
+    elif args.command == 'migrate':
+        migrate()
+    elif args.command == 'export':
+        export_file(args.ladder, args.output, args.since)
+    elif args.command == 'rebuild':
+        rebuild(args.jobs, args.progress, args.restart)
+    else:
+        serve()
+
+
+def parse_args() -> argparse.Namespace:
+    """Parse the command line, running the server is the default."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('serve', help='Run the development server.')
+    importer = commands.add_parser(
+        'import', help='Import games from a JSON lines or CSV file.')
+    importer.add_argument('ladder')
+    importer.add_argument('file')
+    importer.add_argument('--format', choices=['jsonl', 'csv'],
+                          help='Guessed from the file extension by default.')
+    compactor = commands.add_parser(
+        'compact', help='Move old rating history into the packed archive.')
+    compactor.add_argument('--ladder', help='All ladders by default.')
+    compactor.add_argument('--older-than', type=float,
+                           default=compaction.OLDER_THAN,
+                           help='Age of the compacted history, in days.')
+    compactor.add_argument('--points', type=int,
+                           help='Downsample the archived history of each '
+                           'player to about this many points.')
+    compactor.add_argument('--vacuum', action='store_true',
+                           help='Give the freed space back to the system.')
+    commands.add_parser('migrate',
+                        help='Bring the schema of the database up to date.')
+    exporter = commands.add_parser(
+        'export', help='Export games with their ratings as JSON lines.')
+    exporter.add_argument('ladder')
+    exporter.add_argument('--output', help='Standard output by default.')
+    exporter.add_argument('--since', type=int, default=0,
+                          help='Export only games after this id.')
+    rebuilder = commands.add_parser(
+        'rebuild', help='Replay all ladders from scratch, in parallel.')
+    rebuilder.add_argument('--jobs', type=int, default=os.cpu_count(),
+                           help='Number of worker processes.')
+    rebuilder.add_argument('--progress', default='rebuild.progress',
+                           help='File listing the ladders already rebuilt.')
+    rebuilder.add_argument('--restart', action='store_true',
+                           help='Discard the progress of an earlier run.')
+    args = parser.parse_args()
+    if args.command == 'compact' and args.points is not None \
+            and args.points < 2:
+        parser.error('--points must be at least 2')
+    return args
+
+
+def import_file(ladder: str, path: str, file_format: Optional[str]) -> None:
+    """Import games from a file and rate them."""
+    if file_format is None:
+        file_format = 'csv' if path.endswith('.csv') else 'jsonl'
+    if file_format == 'csv':
+        parse = ingest.parse_csv
+    else:
+        parse = ingest.parse_jsonl
+    dbh = database.connect()
+    with open(path, newline='') as lines:
+        count = ingest.import_games(dbh, ladder, parse(lines))
+    logging.info('Imported %d games, rating them.', count)
+    Ranking(ladder, dbh).recalculate()
+
+
+def export_file(ladder: str, path: Optional[str], since: int) -> None:
+    """Export games of a ladder to a file or the standard output."""
+    lines = export.export_lines(database.connect(), ladder, since)
+    if path:
+        with open(path, 'w') as output:
+            output.writelines(lines)
+    else:
+        sys.stdout.writelines(lines)
+
+
+def rebuild(jobs: int, progress_path: str, restart: bool) -> None:
+    """Replay all ladders from scratch in a pool of processes.
+
+    Every rebuilt ladder is appended to the progress file, so that an
+    interrupted run resumes with the remaining ones. The file is removed
+    once all ladders are done.
+    """
+    if restart and os.path.exists(progress_path):
+        os.remove(progress_path)
+    done = set()
+    if os.path.exists(progress_path):
+        with open(progress_path) as progress:
+            done = set(progress.read().splitlines())
+    dbh = database.connect()
+    ladders = [row['name'] for row in dbh.execute('select name from ladders')
+               if row['name'] not in done]
+    dbh.close()
+    logging.info('Rebuilding %d ladders, %d done before.',
+                 len(ladders), len(done))
+    started = time.perf_counter()
+    with open(progress_path, 'a') as progress, \
+            multiprocessing.Pool(jobs) as pool:
+        for number, (ladder, games_count) in enumerate(
+                pool.imap_unordered(rebuild_ladder, ladders), 1):
+            progress.write(ladder + '\n')
+            progress.flush()
+            logging.info('%d/%d: rebuilt %s from %d games, %.1f s elapsed.',
+                         number, len(ladders), ladder, games_count,
+                         time.perf_counter() - started)
+    os.remove(progress_path)
+
+
+def rebuild_ladder(ladder: str) -> Tuple[str, int]:
+    """Replay a ladder from scratch, in a worker process of rebuild."""
+    return ladder, Ranking(ladder, database.connection()).rebuild()
+
+
+def serve() -> None:
+    """Run the development server, creating the database if needed."""
     if 'INTEGRATION_TEST' in os.environ:
         # Try to clean up a local debugging instance, ignore errors.
         try:
-            os.remove('ladders.db')
+            os.remove(database.DB_PATH)
         except (FileNotFoundError, PermissionError):
             pass
-    if not os.path.exists('ladders.db'):
-        dbh = sqlite3.connect('ladders.db')
+    created = not os.path.exists(database.DB_PATH)
+    dbh = database.connect()
+    if created:
         dbh.execute('PRAGMA foreign_keys = ON')
-        with open('ladders.sql') as schema:
-            dbh.cursor().executescript(schema.read())
+        migrations.create(dbh)
+    else:
+        migrations.migrate(dbh)
+    dbh.close()
     app.run(debug=False)
 
 
+def compact(ladder: Optional[str], older_than: float, points: Optional[int],
+            vacuum: bool) -> None:
+    """Compact the old history of one or all ladders."""
+    dbh = database.connect()
+    if ladder is None:
+        ladders = [row['name'] for row in dbh.execute('select name from ladders')]
+    else:
+        ladders = [ladder]
+    count = sum(compaction.compact(dbh, name, older_than, points)
+                for name in ladders)
+    logging.info('Compacted %d history rows of %d ladders.',
+                 count, len(ladders))
+    if vacuum:
+        dbh.execute('vacuum')
+
+
+def migrate() -> None:
+    """Bring the schema of the database up to date."""
+    dbh = database.connect()
+    count = migrations.migrate(dbh)
+    logging.info('Applied %d migrations, the schema is at version %d.',
+                 count, migrations.version(dbh))
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,4 @@
+"""Benchmarks of the ranking and the api hot paths on synthetic ladders.
+
+Run `python -m bench --help` from the repository root.
+"""
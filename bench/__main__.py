@@ -0,0 +1,176 @@
+"""Run the benchmarks and write the results as json."""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import database
+import ingest
+from bench.generate import START, generate
+from ranking import Ranking
+
+# Tokens are not verified, so that submit can be timed without Google.
+os.environ['INTEGRATION_TEST'] = '1'
+import api  # pylint: disable=wrong-import-position
+
+
+def main() -> None:
+    """Generate a database, time the hot paths, print or save the results."""
+    args = parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        database.DB_PATH = os.path.join(directory, 'ladders.db')
+        started = time.perf_counter()
+        ladder = generate(database.DB_PATH, players=args.players,
+                          games=args.games, teams_count=args.teams_count,
+                          players_per_team=args.players_per_team,
+                          skill_spread=args.skill_spread, seed=args.seed,
+                          rate=False)[0]
+        results = {
+            'commit': git_commit(),
+            'params': vars(args),
+            'generate_seconds': time.perf_counter() - started,
+            'ranking': bench_ranking(ladder, args),
+            'endpoints': bench_endpoints(ladder, args),
+        }
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as out:
+            out.write(output + '\n')
+    else:
+        print(output)
+
+
+def parse_args() -> argparse.Namespace:
+    """Parse the command line."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--players', type=int, default=1000)
+    parser.add_argument('--games', type=int, default=20000)
+    parser.add_argument('--teams-count', type=int, default=2)
+    parser.add_argument('--players-per-team', type=int, default=1)
+    parser.add_argument('--skill-spread', type=float, default=200.)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=50,
+                        help='Number of timed runs of each request.')
+    parser.add_argument('--output', help='Write json here, not to stdout.')
+    return parser.parse_args()
+
+
+def git_commit() -> Optional[str]:
+    """Return the checked out commit, to tell the results apart."""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'],
+                              stdout=subprocess.PIPE, check=True,
+                              universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def summarize(seconds: List[float]) -> Dict[str, float]:
+    """Latency statistics in milliseconds."""
+    ordered = sorted(seconds)
+    return {
+        'runs': len(ordered),
+        'mean_ms': 1000 * sum(ordered) / len(ordered),
+        'p50_ms': 1000 * ordered[len(ordered) // 2],
+        'p95_ms': 1000 * ordered[min(len(ordered) - 1,
+                                     int(len(ordered) * .95))],
+        'max_ms': 1000 * ordered[-1],
+    }
+
+
+def bench_ranking(ladder: str, args: argparse.Namespace) -> Dict[str, Any]:
+    """Time recalculation from scratch and after single new games."""
+    dbh = database.connect()
+    started = time.perf_counter()
+    Ranking(ladder, dbh).recalculate()
+    from_scratch = time.perf_counter() - started
+    rnd = random.Random(args.seed)
+    roster = ['player%d' % i for i in range(args.players)]
+    incremental = []
+    for number in range(args.repeat):
+        chosen = rnd.sample(roster, args.teams_count * args.players_per_team)
+        outcome = [chosen[i::args.teams_count]
+                   for i in range(args.teams_count)]
+        ingest.import_games(dbh, ladder, [ingest.ImportedGame(
+            START + (args.games + number) * 60, outcome)])
+        started = time.perf_counter()
+        Ranking(ladder, dbh).recalculate()
+        incremental.append(time.perf_counter() - started)
+    dbh.close()
+    return {
+        'from_scratch_seconds': from_scratch,
+        'from_scratch_games_per_second': args.games / from_scratch,
+        'incremental': summarize(incremental),
+    }
+
+
+def bench_endpoints(ladder: str, args: argparse.Namespace) -> Dict[str, Any]:
+    """Time the api requests through Flask's test client.
+
+    Reads are timed both with the response cache emptied before every
+    request and with it warm. SQL statements are counted by a trace callback
+    on the connection the requests use.
+    """
+    client = api.app.test_client()
+    statements = [0]
+
+    def count(_statement: str) -> None:
+        statements[0] += 1
+    database.connection().set_trace_callback(count)
+    rnd = random.Random(args.seed)
+    roster = ['player%d' % i for i in range(args.players)]
+
+    def submit() -> Any:
+        chosen = rnd.sample(roster, args.teams_count * args.players_per_team)
+        outcome = [[{'name': name} for name in chosen[i::args.teams_count]]
+                   for i in range(args.teams_count)]
+        return client.post('/api/%s/game' % ladder,
+                           data=json.dumps({'outcome': outcome}),
+                           content_type='application/json')
+    reads = {
+        'ranking': lambda: client.get('/api/%s/ranking' % ladder),
+        'matches': lambda: client.post('/api/%s/matches/20' % ladder,
+                                       data='{}',
+                                       content_type='application/json'),
+        'history': lambda: client.get('/api/%s/history/player0' % ladder),
+        'suggest_players': lambda: client.get(
+            '/api/%s/suggest_players/player1' % ladder),
+    }
+    results = {}
+    for name, request in reads.items():
+        results[name] = time_requests(request, args.repeat, statements,
+                                      api.RESPONSES.clear)
+        results[name + ' (cached)'] = time_requests(request, args.repeat,
+                                                    statements)
+    results['submit'] = time_requests(submit, args.repeat, statements)
+    database.connection().set_trace_callback(None)
+    return results
+
+
+def time_requests(request: Callable[[], Any], repeat: int,
+                  statements: List[int],
+                  before: Callable[[], None] = None) -> Dict[str, float]:
+    """Run the request repeatedly, return latencies and statement counts."""
+    seconds = []
+    statements[0] = 0
+    for _ in range(repeat):
+        if before is not None:
+            before()
+        started = time.perf_counter()
+        response = request()
+        seconds.append(time.perf_counter() - started)
+        if response.status_code >= 400:
+            sys.exit('Request failed with %d.' % response.status_code)
+    result = summarize(seconds)
+    result['statements_per_request'] = statements[0] / repeat
+    return result
+
+
+if __name__ == '__main__':
+    main()
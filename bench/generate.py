@@ -0,0 +1,55 @@
+"""Generate synthetic ladders databases."""
+
+import random
+from typing import Iterator, List
+
+import database
+import ingest
+import migrations
+from ranking import Ranking
+
+# Timestamp of the first generated game.
+START = 1500000000
+
+
+def generate(path: str, ladders: int = 1, players: int = 1000,
+             games: int = 10000, teams_count: int = 2,
+             players_per_team: int = 1, skill_spread: float = 200.,
+             seed: int = 0, rate: bool = True) -> List[str]:
+    """Create a database at path with synthetic ladders, return their names.
+
+    Players get a hidden skill drawn from a normal distribution with the
+    given spread. Each game draws its participants uniformly and orders the
+    teams by their noisy performance, so the ratings have something to
+    converge to.
+    """
+    rnd = random.Random(seed)
+    dbh = database.connect(path)
+    migrations.create(dbh)
+    names = []
+    for number in range(ladders):
+        name = 'bench%d' % number
+        with dbh:
+            dbh.execute('insert into ladders (name, teams_count, '
+                        'players_per_team) values (?, ?, ?)',
+                        [name, teams_count, players_per_team])
+        skills = {'player%d' % i: rnd.gauss(1200, skill_spread)
+                  for i in range(players)}
+        ingest.import_games(dbh, name, _games(rnd, skills, games, teams_count,
+                                              players_per_team))
+        if rate:
+            Ranking(name, dbh).recalculate()
+        names.append(name)
+    dbh.close()
+    return names
+
+
+def _games(rnd: random.Random, skills: dict, count: int, teams_count: int,
+           players_per_team: int) -> Iterator[ingest.ImportedGame]:
+    roster = list(skills)
+    for number in range(count):
+        chosen = rnd.sample(roster, teams_count * players_per_team)
+        teams = [chosen[i::teams_count] for i in range(teams_count)]
+        teams.sort(key=lambda team: -sum(rnd.gauss(skills[name], 200)
+                                         for name in team))
+        yield ingest.ImportedGame(START + number * 60, teams)
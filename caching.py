@@ -0,0 +1,67 @@
+"""Small in-process caches shared by the request handlers."""
+
+import collections
+import threading
+from typing import Any, Callable, Hashable, Optional
+
+
+class LRUCache(object):
+    """A bounded mapping evicting the least recently used entries.
+
+    With `max_size`, the total of the values' sizes is bounded as well,
+    values larger than that on their own are not stored at all. Safe to use
+    from several request threads of a worker.
+    """
+
+    def __init__(self, max_entries: int, max_size: Optional[int] = None,
+                 sizeof: Callable[[Any], int] = len) -> None:
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self._entries: 'collections.OrderedDict[Hashable, Any]' = \
+            collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        """Return the value stored under the key and mark it as recently used."""
+        with self._lock:
+            try:
+                self._entries.move_to_end(key)
+            except KeyError:
+                return default
+            return self._entries[key]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """Store the value, evicting the least recently used ones if full."""
+        size = self.sizeof(value) if self.max_size is not None else 0
+        with self._lock:
+            self._forget(key)
+            if self.max_size is not None and size > self.max_size:
+                return
+            self._entries[key] = value
+            self.size += size
+            while (len(self._entries) > self.max_entries or
+                   self.max_size is not None and self.size > self.max_size):
+                self._forget(next(iter(self._entries)))
+
+    def pop(self, key: Hashable) -> None:
+        """Forget the key, if present."""
+        with self._lock:
+            self._forget(key)
+
+    def clear(self) -> None:
+        """Forget all the entries."""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _forget(self, key: Hashable) -> None:
+        """Drop the entry, the lock being held."""
+        if key in self._entries:
+            value = self._entries.pop(key)
+            if self.max_size is not None:
+                self.size -= self.sizeof(value)
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,145 @@
+"""Compaction of old rating history into one packed blob per player."""
+
+import array
+import itertools
+import logging
+import math
+import sqlite3
+import sys
+import time
+import zlib
+from typing import List, Optional, Sequence, Tuple
+
+import downsample
+
+# A (timestamp, mu, sigma, game) point of the history, sigma and game being
+# None in rows from before they were recorded.
+Point = Tuple[int, float, Optional[float], Optional[int]]
+
+# Age of the history rows compacted by default, in days.
+OLDER_THAN = 30
+
+
+def pack(points: Sequence[Point]) -> bytes:
+    """Pack points as columns, compressed by zlib.
+
+    Timestamps and games are stored as differences from the previous point,
+    little-endian 64-bit integers, which compress well. Mus and sigmas are
+    little-endian doubles, so they are restored exactly.
+    """
+    timestamps = array.array('q', (point[0] for point in points))
+    games = array.array('q', (point[3] or 0 for point in points))
+    for column in (timestamps, games):
+        for i in range(len(column) - 1, 0, -1):
+            column[i] -= column[i - 1]
+    values = array.array('d', (point[1] for point in points))
+    values.extend(float('nan') if point[2] is None else point[2]
+                  for point in points)
+    if sys.byteorder == 'big':
+        for integers in (timestamps, games):
+            integers.byteswap()
+        values.byteswap()
+    return zlib.compress(timestamps.tobytes() + games.tobytes() +
+                         values.tobytes(), 9)
+
+
+def unpack(blob: bytes) -> List[Point]:
+    """Restore points packed by `pack`."""
+    data = zlib.decompress(blob)
+    size = len(data) // 32
+    timestamps = array.array('q', data[:8 * size])
+    games = array.array('q', data[8 * size:16 * size])
+    values = array.array('d', data[16 * size:])
+    if sys.byteorder == 'big':
+        for integers in (timestamps, games):
+            integers.byteswap()
+        values.byteswap()
+    for column in (timestamps, games):
+        for i in range(1, len(column)):
+            column[i] += column[i - 1]
+    return [(timestamp, mu, None if math.isnan(sigma) else sigma, game or None)
+            for timestamp, game, mu, sigma in zip(
+                timestamps, games, values[:size], values[size:])]
+
+
+def archived(dbh: sqlite3.Connection, ladder: str, player: str,
+             since: int = 0) -> List[Point]:
+    """Return the compacted history of the player, oldest first.
+
+    Nothing is unpacked if all of it is older than `since`.
+    """
+    row = dbh.execute('select points from history_archive '
+                      'where ladder=? and player=? and until>=?',
+                      [ladder, player, since]).fetchone()
+    return unpack(row[0]) if row is not None else []
+
+
+def merge(older: Sequence[Point], newer: Sequence[Point]) -> List[Point]:
+    """Merge two histories keyed by timestamps and games.
+
+    The newer point wins, points without a game are keyed by time only.
+    """
+    merged = {(point[0], point[3] or 0): point for point in older}
+    merged.update(((point[0], point[3] or 0), point) for point in newer)
+    return [merged[key] for key in sorted(merged)]
+
+
+def compact(dbh: sqlite3.Connection, ladder: str,
+            older_than: float = OLDER_THAN,
+            points: Optional[int] = None) -> int:
+    """Move history rows older than the given days into the archive.
+
+    With `points`, the archived history of every player is downsampled to
+    about that many points. Runs in one transaction, returns the number of
+    rows compacted.
+    """
+    cutoff = int(time.time() - older_than * 24 * 3600)
+    with dbh:  # Automatically commit/rollback.
+        dbh.execute('begin immediate')
+        rows = dbh.execute('select player, timestamp, mu, sigma, game '
+                           'from history where ladder=? and timestamp<? '
+                           'order by player, timestamp, game',
+                           [ladder, cutoff])
+        for player, player_rows in itertools.groupby(rows,
+                                                     key=lambda row: row[0]):
+            history = merge(archived(dbh, ladder, player),
+                            [tuple(row[1:]) for row in player_rows])
+            if points is not None:
+                history = [history[i] for i in downsample.lttb(
+                    [point[0] for point in history],
+                    [point[1] for point in history], points)]
+            dbh.execute('insert or replace into history_archive (ladder, '
+                        'player, until, last_game, points) values (?,?,?,?,?)',
+                        [ladder, player, history[-1][0],
+                         max(point[3] or 0 for point in history),
+                         pack(history)])
+        cursor = dbh.execute('delete from history where ladder=? and '
+                             'timestamp<?', [ladder, cutoff])
+        compacted = cursor.rowcount
+        if compacted:
+            dbh.execute('update ladders set version = version + 1 '
+                        'where name = ?', [ladder])
+    if compacted:
+        logging.info('Compacted %d history rows of ladder %s.',
+                     compacted, ladder)
+    return compacted
+
+
+def trim(dbh: sqlite3.Connection, ladder: str, game_id: int) -> None:
+    """Drop archived points of games after the given one.
+
+    Used when the ratings are rewound, within the caller's transaction.
+    """
+    for player, blob in dbh.execute(
+            'select player, points from history_archive '
+            'where ladder=? and last_game>?', [ladder, game_id]).fetchall():
+        history = [point for point in unpack(blob)
+                   if (point[3] or 0) <= game_id]
+        if not history:
+            dbh.execute('delete from history_archive '
+                        'where ladder=? and player=?', [ladder, player])
+            continue
+        dbh.execute('update history_archive set until=?, last_game=?, '
+                    'points=? where ladder=? and player=?',
+                    [history[-1][0], max(point[3] or 0 for point in history),
+                     pack(history), ladder, player])
@@ -0,0 +1,71 @@
+"""Persistent SQLite connections, one per worker process and thread."""
+
+import os
+import sqlite3
+import threading
+from typing import Optional
+
+import metrics
+
+DB_PATH = os.environ.get('LADDERS_DB', 'ladders.db')
+# How long a writer waits for the lock held by another one, in milliseconds.
+BUSY_TIMEOUT = int(os.environ.get('LADDERS_DB_BUSY_TIMEOUT', 5000))
+# Page cache of each connection, in KiB.
+CACHE_SIZE = int(os.environ.get('LADDERS_DB_CACHE_SIZE', 16384))
+# Size of the memory mapped part of the database file, in bytes.
+MMAP_SIZE = int(os.environ.get('LADDERS_DB_MMAP_SIZE', 256 * 1024 * 1024))
+# Number of prepared statements kept by each connection.
+STATEMENT_CACHE = 256
+
+_LOCAL = threading.local()
+
+
+def connect(path: Optional[str] = None) -> sqlite3.Connection:
+    """Open a new connection with the pragmas tuned for the api.
+
+    WAL lets the readers proceed while a game is being written, and with it
+    the NORMAL synchronous mode is still safe from corruption. With metrics
+    enabled, the connection times every statement.
+    """
+    factory = (metrics.InstrumentedConnection if metrics.ENABLED
+               else sqlite3.Connection)
+    dbh = sqlite3.connect(path or DB_PATH, timeout=BUSY_TIMEOUT / 1000,
+                          cached_statements=STATEMENT_CACHE, factory=factory)
+    dbh.row_factory = sqlite3.Row
+    dbh.execute('pragma journal_mode = wal')
+    dbh.execute('pragma synchronous = normal')
+    dbh.execute('pragma busy_timeout = %d' % BUSY_TIMEOUT)
+    dbh.execute('pragma cache_size = -%d' % CACHE_SIZE)
+    dbh.execute('pragma mmap_size = %d' % MMAP_SIZE)
+    return dbh
+
+
+def connection() -> sqlite3.Connection:
+    """Return the connection of the current thread, opening it if needed.
+
+    Connections are kept open across requests, so their page and statement
+    caches stay warm. A forked worker never reuses the parent's connection.
+    """
+    key = (os.getpid(), DB_PATH)
+    if getattr(_LOCAL, 'key', None) != key:
+        _LOCAL.dbh = connect()
+        _LOCAL.key = key
+    return _LOCAL.dbh
+
+
+def allocate_game_ids(cursor: sqlite3.Cursor, count: int = 1) -> int:
+    """Reserve ids for new games, return the first one.
+
+    Ids come from a sequence, so they are never reused, not even after the
+    latest games are removed. Call within the transaction inserting them.
+    """
+    cursor.execute("update sequences set value = value + ? "
+                   "where name = 'games'", [count])
+    cursor.execute("select value from sequences where name = 'games'")
+    return cursor.fetchone()[0] - count + 1
+
+
+def release(dbh: sqlite3.Connection) -> None:
+    """Return the connection after a request, rolling back anything left."""
+    if dbh.in_transaction:
+        dbh.rollback()
@@ -0,0 +1,37 @@
+"""Downsampling of time series for charts."""
+
+from typing import List, Sequence
+
+
+def lttb(xs: Sequence[float], ys: Sequence[float], threshold: int) -> List[int]:
+    """Pick indices of points by the largest-triangle-three-buckets method.
+
+    The first and the last point are always kept. The rest is split into
+    buckets and from each the point forming the largest triangle with the
+    previously picked point and the average of the next bucket is chosen,
+    which keeps the visual shape of the line. Raises ValueError if fewer
+    than two points are asked for.
+    """
+    if threshold < 2:
+        raise ValueError('At least the first and last point are kept.')
+    size = len(xs)
+    if threshold >= size:
+        return list(range(size))
+    if threshold == 2:
+        return [0, size - 1]
+    every = (size - 2) / (threshold - 2)
+    picked = [0]
+    previous = 0
+    for bucket in range(threshold - 2):
+        start = int(bucket * every) + 1
+        end = int((bucket + 1) * every) + 1
+        next_end = min(int((bucket + 2) * every) + 1, size)
+        avg_x = sum(xs[end:next_end]) / (next_end - end)
+        avg_y = sum(ys[end:next_end]) / (next_end - end)
+        prev_x, prev_y = xs[previous], ys[previous]
+        previous = max(range(start, end), key=lambda i: abs(
+            (prev_x - avg_x) * (ys[i] - prev_y) -
+            (prev_x - xs[i]) * (avg_y - prev_y)))
+        picked.append(previous)
+    picked.append(size - 1)
+    return picked
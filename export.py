@@ -0,0 +1,47 @@
+"""Streaming export of ladders as JSON lines."""
+
+import itertools
+import json
+import sqlite3
+from typing import Any, Dict, Iterator, List
+
+
+def export_games(dbh: sqlite3.Connection, ladder: str,
+                 since: int = 0) -> Iterator[Dict[str, Any]]:
+    """Yield the games after the `since` id, in the order of their ids.
+
+    Every game has its outcome, in the format accepted by the import, and
+    the ratings of its players right after it. A single query is streamed,
+    so the memory used doesn't depend on the size of the ladder.
+
+    Ratings come from the history, looked up by its primary key. They are
+    left out for games not rated yet or whose history was compacted.
+    """
+    cursor = dbh.execute(
+        'select games.id, games.timestamp, participants.player, '
+        'participants.position, history.mu, history.sigma '
+        'from games join participants on participants.game = games.id '
+        'left join history on history.ladder = games.ladder '
+        'and history.player = participants.player '
+        'and history.game = games.id '
+        'where games.ladder = ? and games.id > ? '
+        'order by games.id, participants.position', [ladder, since])
+    for (game_id, timestamp), rows in itertools.groupby(
+            cursor, key=lambda row: (row[0], row[1])):
+        tiers: Dict[int, List[str]] = {}
+        ratings = {}
+        for _, _, player, position, mu, sigma in rows:
+            tiers.setdefault(position, []).append(player)
+            if mu is not None:
+                ratings[player] = [mu, sigma]
+        yield {'id': game_id,
+               'timestamp': timestamp,
+               'outcome': [tiers[position] for position in sorted(tiers)],
+               'ratings': ratings}
+
+
+def export_lines(dbh: sqlite3.Connection, ladder: str,
+                 since: int = 0) -> Iterator[str]:
+    """Yield the games after the `since` id, one json object per line."""
+    for game in export_games(dbh, ladder, since):
+        yield json.dumps(game, sort_keys=True) + '\n'
@@ -0,0 +1,118 @@
+"""Verification of Google ID tokens with cached certificates and identities."""
+
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+import oauth2client.client
+import oauth2client.crypt
+from oauth2client import transport
+
+from caching import LRUCache
+
+# Certificates are refreshed in the background this long before they expire.
+CERTS_REFRESH_MARGIN = 600
+# How long to keep certificates if the response doesn't tell.
+CERTS_DEFAULT_MAX_AGE = 3600
+
+# A source of certificates returns them along with their expiration time.
+CertSource = Callable[[], Tuple[Dict[str, str], float]]
+
+
+def fetch_google_certs() -> Tuple[Dict[str, str], float]:
+    """Download Google's token signing certificates."""
+    http = transport.get_cached_http()
+    resp, content = transport.request(
+        http, oauth2client.client.ID_TOKEN_VERIFICATION_CERTS)
+    if resp.status != 200:
+        raise oauth2client.client.VerifyJwtTokenError(
+            'Status code: {0}'.format(resp.status))
+    max_age = CERTS_DEFAULT_MAX_AGE
+    match = re.search(r'max-age=(\d+)', resp.get('cache-control', ''))
+    if match:
+        max_age = int(match.group(1))
+    return json.loads(content.decode('utf-8')), time.time() + max_age
+
+
+class CertificateCache(object):
+    """Keep the signing certificates, refreshing them ahead of expiration.
+
+    Only the very first request waits for the certificates to be fetched.
+    Afterwards they are refreshed by a background thread while the old ones
+    are still being served.
+    """
+
+    def __init__(self, source: CertSource = fetch_google_certs,
+                 refresh_margin: float = CERTS_REFRESH_MARGIN) -> None:
+        self.source = source
+        self.refresh_margin = refresh_margin
+        self._certs: Optional[Dict[str, str]] = None
+        self._expiry = 0.0
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def get(self) -> Dict[str, str]:
+        """Return the current certificates."""
+        now = time.time()
+        certs = self._certs
+        if certs is None or now >= self._expiry:
+            certs = self.refresh()
+        elif now >= self._expiry - self.refresh_margin:
+            with self._lock:
+                start, self._refreshing = not self._refreshing, True
+            if start:
+                threading.Thread(target=self._refresh_in_background,
+                                 daemon=True).start()
+        return certs
+
+    def refresh(self) -> Dict[str, str]:
+        """Fetch the certificates from the source and return them."""
+        certs, expiry = self.source()
+        with self._lock:
+            self._certs, self._expiry = certs, expiry
+        return certs
+
+    def _refresh_in_background(self) -> None:
+        try:
+            self.refresh()
+        except Exception:  # pylint: disable=broad-except
+            logging.exception('Failed to refresh the certificates.')
+        finally:
+            self._refreshing = False
+
+
+class IdentityVerifier(object):
+    """Verify ID tokens, remembering the identities of the good ones.
+
+    Identities are cached under a hash of the token until the token expires.
+    """
+
+    def __init__(self, audiences: Iterable[str], issuers: Iterable[str],
+                 certs: Optional[CertificateCache] = None,
+                 max_entries: int = 4096) -> None:
+        self.audiences = frozenset(audiences)
+        self.issuers = frozenset(issuers)
+        self.certs = certs if certs is not None else CertificateCache()
+        self.identities = LRUCache(max_entries)
+
+    def verify(self, token: str) -> str:
+        """Return the user id of the token.
+
+        Raises oauth2client.crypt.AppIdentityError if the token is not valid.
+        """
+        key = hashlib.sha256(token.encode('utf-8')).digest()
+        cached = self.identities.get(key)
+        if cached is not None and cached[1] > time.time():
+            return cached[0]
+        idinfo = oauth2client.crypt.verify_signed_jwt_with_certs(
+            token, self.certs.get(), None)
+        if idinfo['aud'] not in self.audiences:
+            raise oauth2client.crypt.AppIdentityError('Unrecognized client.')
+        if idinfo['iss'] not in self.issuers:
+            raise oauth2client.crypt.AppIdentityError('Wrong issuer.')
+        self.identities.put(key, (idinfo['sub'], idinfo['exp']))
+        return idinfo['sub']
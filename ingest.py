@@ -0,0 +1,171 @@
+"""Bulk import of game results."""
+
+import csv
+import itertools
+import json
+import shutil
+import sqlite3
+import tempfile
+import time
+from typing import IO, Any, Iterable, Iterator, List, NamedTuple, Optional
+
+import database
+
+# Number of games inserted by a single batch of statements.
+BATCH_SIZE = 10000
+# Uploads larger than this are spooled to a temporary file, in bytes.
+SPOOL_SIZE = 4 * 1024 * 1024
+
+
+class ImportedGame(NamedTuple):
+    """A game to be imported, with the tiers of players best first."""
+    timestamp: int
+    outcome: List[List[str]]
+
+
+def parse_jsonl(lines: Iterable[str]) -> Iterator[ImportedGame]:
+    """Parse games written one json object per line.
+
+    Each object has a `timestamp` and an `outcome` in the format accepted by
+    the game endpoint. Members may also be given just by their names.
+    """
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            game = json.loads(line)
+            yield ImportedGame(int(game.get('timestamp', time.time())),
+                               [[_member_name(member) for member in tier]
+                                for tier in game['outcome']])
+        except (ValueError, TypeError, KeyError, AttributeError):
+            raise ValueError('Malformed game on line %d.' % number)
+
+
+def parse_csv(lines: Iterable[str]) -> Iterator[ImportedGame]:
+    """Parse games written one per row.
+
+    Each row is a timestamp followed by the tiers, best first, with the
+    members of a tier separated by semicolons.
+    """
+    for number, row in enumerate(csv.reader(lines), 1):
+        if not row:
+            continue
+        try:
+            yield ImportedGame(int(row[0]), [tier.split(';')
+                                             for tier in row[1:]])
+        except ValueError:
+            raise ValueError('Malformed game on row %d.' % number)
+
+
+def _member_name(member: Any) -> str:
+    if isinstance(member, str):
+        return member
+    return member['name']
+
+
+def spool(stream: IO[bytes]) -> IO[bytes]:
+    """Copy an upload to a temporary file, kept in memory if small.
+
+    The whole upload is then received before the import takes the write
+    lock, so a slow client doesn't hold it.
+    """
+    body = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+    shutil.copyfileobj(stream, body)
+    return body
+
+
+def read_lines(body: IO[bytes]) -> Iterator[str]:
+    """Decode the lines of a spooled upload, from its start."""
+    body.seek(0)
+    for line in body:
+        yield line.decode('utf-8')
+
+
+def check_games(games: Iterable[ImportedGame]) -> int:
+    """Check the games without the database, return how many there are.
+
+    Raises ValueError for any game `import_games` would refuse, except the
+    ones older than the games already on the ladder.
+    """
+    count = latest = 0
+    for count, game in enumerate(games, 1):
+        latest = _check(game, latest)
+    return count
+
+
+def _check(game: ImportedGame, latest: int) -> int:
+    """Raise ValueError if the game can't follow one played at `latest`.
+
+    Returns the timestamp of the game.
+    """
+    if len([members for members in game.outcome if members]) < 2:
+        raise ValueError('Game with fewer than two tiers.')
+    if game.timestamp < latest:
+        raise ValueError('Game older than the ones before it.')
+    if not all(name for members in game.outcome for name in members):
+        raise ValueError('Empty player name.')
+    return game.timestamp
+
+
+def import_games(dbh: sqlite3.Connection, ladder: str,
+                 games: Iterable[ImportedGame],
+                 reporter_uid: Optional[str] = None,
+                 reporter_ip: Optional[str] = None) -> int:
+    """Insert the games into the ladder, return how many there were.
+
+    Everything happens in one transaction, which is rolled back if any game
+    is malformed. It holds the write lock, so uploads are received and
+    checked by `check_games` first. Ratings are not updated here.
+
+    Games are rated in the order of their ids, so they must come in the
+    order of their timestamps and not be older than any game already on the
+    ladder. A past season can only be imported before the games after it,
+    otherwise ValueError is raised and nothing is inserted. Rewinding the
+    ratings would be needed instead, which for a large ladder means
+    replaying most of it within the import's transaction.
+    """
+    count = created = 0
+    with dbh:  # Automatically commit/rollback.
+        dbh.execute('begin immediate')
+        cursor = dbh.cursor()
+        cursor.execute('select mu, sigma from ladders where name=?', [ladder])
+        conf = cursor.fetchone()
+        if conf is None:
+            raise ValueError('No such ladder.')
+        cursor.execute('select coalesce(max(timestamp), 0) from games '
+                       'where ladder=?', [ladder])
+        latest = cursor.fetchone()[0]
+        games = iter(games)
+        while True:
+            batch = list(itertools.islice(games, BATCH_SIZE))
+            if not batch:
+                break
+            next_id = database.allocate_game_ids(cursor, len(batch))
+            names = set()
+            rows, participants = [], []
+            for game_id, game in enumerate(batch, next_id):
+                latest = _check(game, latest)
+                rows.append((game_id, ladder, game.timestamp, reporter_uid,
+                             reporter_ip))
+                for position, members in enumerate(game.outcome):
+                    for name in members:
+                        names.add(name)
+                        participants.append((game_id, name, position))
+            cursor.executemany('insert or ignore into players '
+                               '(name, ladder, mu, sigma) values (?,?,?,?)',
+                               [(name, ladder, conf['mu'], conf['sigma'])
+                                for name in names])
+            created += cursor.rowcount
+            cursor.executemany('insert into games (id, ladder, timestamp, '
+                               'reporter_uid, reporter_ip) '
+                               'values (?,?,?,?,?)', rows)
+            cursor.executemany('insert into participants '
+                               '(game, player, position) values (?, ?, ?)',
+                               participants)
+            count += len(batch)
+        cursor.execute('update ladders set version = version + 1 '
+                       'where name = ?', [ladder])
+        if created:
+            cursor.execute('update ladders set roster_version = '
+                           'roster_version + 1 where name = ?', [ladder])
+    return count
@@ -0,0 +1,86 @@
+"""Positions of players within a ladder."""
+
+import sqlite3
+from typing import Any, Dict, List, Optional, Tuple
+
+# Conservative skill, which the players are sure to have with about 99.7%
+# probability. Matches the expression index on players.
+CONSERVATIVE = 'mu - 3 * sigma'
+
+COLUMNS = 'name, mu, sigma, games_count, wins_count'
+
+
+class Leaderboard(object):
+    """Standings of a ladder, answering position queries from an index.
+
+    Ranks are counts over players_by_mu or players_by_conservative and
+    neighbours are short seeks in it, so nothing loads the whole ladder.
+    Players are ordered as a backwards scan of the index gives them, best
+    score first and equal scores by their row ids. Players with equal
+    scores share the better rank.
+    """
+
+    def __init__(self, dbh: sqlite3.Connection, ladder: str,
+                 conservative: bool = False) -> None:
+        self.dbh = dbh
+        self.ladder = ladder
+        self.order = CONSERVATIVE if conservative else 'mu'
+
+    def __len__(self) -> int:
+        return self._count('')
+
+    def player(self, name: str) -> Optional[Dict[str, Any]]:
+        """Return the standing of the player, None if not on the ladder."""
+        row = self.dbh.execute('select ' + COLUMNS + ' from players '
+                               'where ladder=? and name=?',
+                               [self.ladder, name]).fetchone()
+        return dict(row) if row is not None else None
+
+    def rank(self, name: str) -> Optional[int]:
+        """Return the 1-based rank of the player, None if not on the ladder."""
+        position = self._position(name)
+        if position is None:
+            return None
+        return self._count('and ' + self.order + ' > ?', position[0]) + 1
+
+    def percentile(self, name: str) -> Optional[float]:
+        """Return the percentage of the players ranked below the player."""
+        position = self._position(name)
+        if position is None:
+            return None
+        total = len(self)
+        below = total - self._count('and ' + self.order + ' >= ?', position[0])
+        return 100. * below / total
+
+    def neighbours(self, name: str, count: int
+                  ) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+        """Return up to `count` players right above and right below."""
+        position = self._position(name)
+        if position is None:
+            raise KeyError(name)
+        score, rowid = position
+        above = self.dbh.execute(
+            'select ' + COLUMNS + ' from players where ladder=? and ' +
+            self.order + ' >= ? and (' + self.order + ' > ? or rowid > ?) '
+            'order by ' + self.order + ', rowid limit ?',
+            [self.ladder, score, score, rowid, count]).fetchall()
+        below = self.dbh.execute(
+            'select ' + COLUMNS + ' from players where ladder=? and ' +
+            self.order + ' <= ? and (' + self.order + ' < ? or rowid < ?) '
+            'order by ' + self.order + ' desc, rowid desc limit ?',
+            [self.ladder, score, score, rowid, count]).fetchall()
+        return ([dict(row) for row in reversed(above)],
+                [dict(row) for row in below])
+
+    def _position(self, name: str) -> Optional[Tuple[float, int]]:
+        """Return the score and row id of the player."""
+        row = self.dbh.execute('select ' + self.order + ', rowid '
+                               'from players where ladder=? and name=?',
+                               [self.ladder, name]).fetchone()
+        return (row[0], row[1]) if row is not None else None
+
+    def _count(self, condition: str, *params: Any) -> int:
+        """Count the players of the ladder meeting the condition."""
+        return self.dbh.execute('select count(*) from players where ladder=? ' +
+                                condition,
+                                (self.ladder,) + params).fetchone()[0]
@@ -0,0 +1,122 @@
+"""Propose balanced games among a pool of present players.
+
+TrueSkill match quality is the probability of a draw relative to the most
+even game possible. For two players it has a closed form, evaluated here for
+all pairs of the pool at once.
+"""
+
+from typing import Iterator, List, NamedTuple, Sequence, Tuple
+
+import numpy
+import trueskill
+
+# Number of the best partners of every player visited in a round.
+NEIGHBOURS = 16
+
+
+class Match(NamedTuple):
+    """Proposed game, as indices into the pool, and its quality."""
+    teams: List[List[int]]
+    quality: float
+
+
+def quality_matrix(mu: numpy.ndarray, sigma: numpy.ndarray,
+                   beta: float) -> numpy.ndarray:
+    """Return the quality of a one-on-one game of every pair of players."""
+    variance = 2 * beta ** 2 + sigma[:, None] ** 2 + sigma[None, :] ** 2
+    delta = mu[:, None] - mu[None, :]
+    return (numpy.sqrt(2 * beta ** 2 / variance) *
+            numpy.exp(-delta ** 2 / (2 * variance)))
+
+
+def team_quality(tsh: trueskill.TrueSkill, mu: numpy.ndarray,
+                 sigma: numpy.ndarray, teams: Sequence[Sequence[int]]) -> float:
+    """Return the quality of a game of the given teams.
+
+    Two teams have a closed form, more are left to trueskill.
+    """
+    if len(teams) != 2:
+        return tsh.quality([[tsh.create_rating(mu[i], sigma[i]) for i in team]
+                            for team in teams])
+    members = list(teams[0]) + list(teams[1])
+    variance = len(members) * tsh.beta ** 2 + (sigma[members] ** 2).sum()
+    delta = mu[list(teams[0])].sum() - mu[list(teams[1])].sum()
+    return float(numpy.sqrt(len(members) * tsh.beta ** 2 / variance) *
+                 numpy.exp(-delta ** 2 / (2 * variance)))
+
+
+def matchmake(tsh: trueskill.TrueSkill, mu: numpy.ndarray,
+              sigma: numpy.ndarray, teams_count: int,
+              players_per_team: int) -> Tuple[List[Match], List[int]]:
+    """Split the pool into disjoint games, best ones first.
+
+    Greedy: pairs are visited by decreasing quality and each pair of still
+    free players seeds a game. For larger games the group grows by the free
+    player with the best product of qualities against its members. The group
+    is then split into teams by a snake draft on mu. Returns the games and
+    the players left out.
+
+    Only the best few partners of every player are visited, which is enough
+    to seed nearly all games. Another round covers any players left over.
+    """
+    size = len(mu)
+    group_size = teams_count * players_per_team
+    found: List[Match] = []
+    if group_size < 2 or size < group_size:
+        return found, list(range(size))
+    quality = quality_matrix(mu, sigma, tsh.beta)
+    if group_size > 2:
+        with numpy.errstate(divide='ignore'):
+            log_quality = numpy.log(quality)
+    free = numpy.ones(size, dtype=bool)
+    left = size
+    while left >= group_size:
+        # Checked for every visited pair, faster as a list than as an array.
+        taken = (~free).tolist()
+        for first, second in _candidates(quality, numpy.flatnonzero(free)):
+            if left < group_size:
+                break
+            if taken[first] or taken[second]:
+                continue
+            group = [first, second]
+            free[group] = False
+            if group_size > 2:
+                score = log_quality[first] + log_quality[second]
+            while len(group) < group_size:
+                candidate = int(numpy.argmax(
+                    numpy.where(free, score, -numpy.inf)))
+                group.append(candidate)
+                free[candidate] = False
+                score = score + log_quality[candidate]
+            for player in group:
+                taken[player] = True
+            left -= group_size
+            found.append(_split(tsh, mu, sigma, quality, group, teams_count))
+    found.sort(key=lambda match: -match.quality)
+    return found, numpy.flatnonzero(free).tolist()
+
+
+def _candidates(quality: numpy.ndarray,
+                players: numpy.ndarray) -> Iterator[Tuple[int, int]]:
+    """Yield the best pairs among the players, by decreasing quality."""
+    among = quality[numpy.ix_(players, players)]
+    numpy.fill_diagonal(among, -1)
+    partners = min(NEIGHBOURS, len(players) - 1)
+    columns = numpy.argpartition(-among, partners - 1, axis=1)[:, :partners]
+    rows = numpy.repeat(numpy.arange(len(players)), partners)
+    columns = columns.ravel()
+    order = numpy.argsort(-among[rows, columns], kind='mergesort')
+    return zip(players[rows[order]].tolist(), players[columns[order]].tolist())
+
+
+def _split(tsh: trueskill.TrueSkill, mu: numpy.ndarray, sigma: numpy.ndarray,
+           quality: numpy.ndarray, group: List[int], teams_count: int) -> Match:
+    """Split a group into teams by a snake draft on mu."""
+    if len(group) == 2:
+        return Match([[group[0]], [group[1]]],
+                     float(quality[group[0], group[1]]))
+    teams: List[List[int]] = [[] for _ in range(teams_count)]
+    for pick, player in enumerate(sorted(group, key=lambda i: -mu[i])):
+        turn = pick % (2 * teams_count)
+        teams[min(turn, 2 * teams_count - 1 - turn)].append(player)
+    return Match(teams, team_quality(tsh, mu, sigma, teams))
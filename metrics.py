@@ -0,0 +1,163 @@
+"""Process-local metrics, exposed in the Prometheus text format.
+
+Enabled by the LADDERS_METRICS environment variable. When disabled, the
+recording functions return right away and connections are not wrapped.
+Every uwsgi worker keeps its own numbers, so scrape each worker or sum.
+"""
+
+import bisect
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Tuple
+
+ENABLED = bool(os.environ.get('LADDERS_METRICS'))
+
+# Upper bounds of the latency histogram buckets, in seconds.
+BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5,
+           5., 10.)
+
+HELP = {
+    'ladders_requests_seconds': 'Latency of api requests.',
+    'ladders_sql_seconds': 'Latency of SQL statements.',
+    'ladders_auth_seconds': 'Latency of ID token verification.',
+    'ladders_recalculate_seconds': 'Latency of ranking recalculations.',
+    'ladders_rated_games_total': 'Games rated by recalculations.',
+    'ladders_history_rows_total': 'History rows written by recalculations.',
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Registry(object):
+    """Counters and histograms, keyed by name and labels."""
+
+    def __init__(self) -> None:
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.histograms: Dict[Tuple[str, Labels], List[Any]] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, labels: Labels, value: float = 1) -> None:
+        """Increase a counter."""
+        with self._lock:
+            key = (name, labels)
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, labels: Labels, value: float) -> None:
+        """Record a value in a histogram."""
+        with self._lock:
+            # Counts of the buckets, then of +Inf, then the sum.
+            histogram = self.histograms.setdefault(
+                (name, labels), [0] * (len(BUCKETS) + 1) + [0.])
+            histogram[bisect.bisect_left(BUCKETS, value)] += 1
+            histogram[-1] += value
+
+    def render(self) -> str:
+        """Return all the metrics in the Prometheus text format."""
+        lines: List[str] = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, list(value))
+                                for key, value in self.histograms.items())
+        seen = set()
+        for (name, labels), value in counters:
+            if name not in seen:
+                seen.add(name)
+                lines.append('# HELP %s %s' % (name, HELP.get(name, name)))
+                lines.append('# TYPE %s counter' % name)
+            lines.append('%s%s %s' % (name, _format(labels), value))
+        for (name, labels), histogram in histograms:
+            if name not in seen:
+                seen.add(name)
+                lines.append('# HELP %s %s' % (name, HELP.get(name, name)))
+                lines.append('# TYPE %s histogram' % name)
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), histogram):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (
+                    name, _format(labels + (('le', str(bound)),)),
+                    cumulative))
+            lines.append('%s_sum%s %r' % (name, _format(labels),
+                                          histogram[-1]))
+            lines.append('%s_count%s %d' % (name, _format(labels),
+                                            cumulative))
+        return '\n'.join(lines) + '\n'
+
+
+def _format(labels: Labels) -> str:
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (key, str(value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels)
+
+
+REGISTRY = Registry()
+
+
+def inc(name: str, value: float = 1, **labels: Any) -> None:
+    """Increase a counter, if metrics are enabled."""
+    if ENABLED:
+        REGISTRY.inc(name, tuple(sorted(labels.items())), value)
+
+
+def observe(name: str, value: float, **labels: Any) -> None:
+    """Record a value in a histogram, if metrics are enabled."""
+    if ENABLED:
+        REGISTRY.observe(name, tuple(sorted(labels.items())), value)
+
+
+@contextlib.contextmanager
+def timed(name: str, **labels: Any) -> Iterator[None]:
+    """Record the duration of the block in a histogram."""
+    if not ENABLED:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """A cursor recording the latency of statements by their kind."""
+
+    def execute(self, sql: str, parameters: Any = ()) -> 'InstrumentedCursor':
+        with timed('ladders_sql_seconds', statement=_kind(sql)):
+            return super().execute(sql, parameters)
+
+    def executemany(self, sql: str, parameters: Any) -> 'InstrumentedCursor':
+        with timed('ladders_sql_seconds', statement=_kind(sql)):
+            return super().executemany(sql, parameters)
+
+    def executescript(self, sql_script: str) -> sqlite3.Cursor:
+        with timed('ladders_sql_seconds', statement='script'):
+            return super().executescript(sql_script)
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """A connection whose statements are all instrumented.
+
+    The shortcut methods of sqlite3.Connection create their cursors in C,
+    without calling `cursor`, so they are overridden as well.
+    """
+
+    def cursor(self, factory: Any = None) -> Any:
+        return super().cursor(factory or InstrumentedCursor)
+
+    def execute(self, sql: str, parameters: Any = ()) -> sqlite3.Cursor:
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql: str, parameters: Any) -> sqlite3.Cursor:
+        return self.cursor().executemany(sql, parameters)
+
+    def executescript(self, sql_script: str) -> sqlite3.Cursor:
+        return self.cursor().executescript(sql_script)
+
+
+def _kind(sql: str) -> str:
+    return sql.split(None, 1)[0].lower() if sql.strip() else ''
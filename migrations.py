@@ -0,0 +1,161 @@
+"""Versioned schema migrations.
+
+`ladders.sql` is the schema the first databases were created with, version
+0. Every migration moves the schema one version further, recorded in the
+database's user_version. Each runs in its own short transaction, so a live
+database is locked only briefly. Parts of the early migrations were applied
+to some databases by hand, so the migrations check the schema first.
+"""
+
+import logging
+import os
+import sqlite3
+from typing import NamedTuple, Optional, Tuple
+
+SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      'ladders.sql')
+
+
+class Migration(NamedTuple):
+    """Statements moving the schema to the next version."""
+    description: str
+    statements: Tuple[str, ...]
+    # Table and column added by the migration. If the column is present
+    # already, the migration was applied by hand and is skipped.
+    column: Optional[Tuple[str, str]] = None
+
+
+MIGRATIONS = (
+    Migration('Add the cursor of the last rated game.', (
+        'alter table ladders add column last_game integer not null default 0',
+        'update ladders set last_game = (select coalesce(max(id), 0) '
+        'from games where games.ladder = ladders.name '
+        'and games.timestamp <= ladders.last_ranking)',
+    ), ('ladders', 'last_game')),
+    Migration('Add the version of ladders.', (
+        'alter table ladders add column version integer not null default 0',
+    ), ('ladders', 'version')),
+    Migration('Add the version of rosters.', (
+        'alter table ladders add column roster_version integer not null '
+        'default 0',
+    ), ('ladders', 'roster_version')),
+    Migration('Add the game of history rows.', (
+        'alter table history add column game integer',
+    ), ('history', 'game')),
+    Migration('Add the sigma of history rows.', (
+        'alter table history add column sigma float',
+    ), ('history', 'sigma')),
+    Migration('Add rating checkpoints.', (
+        'create table if not exists checkpoints ('
+        'ladder text not null, '
+        'game integer not null, '
+        'player text not null, '
+        'mu float not null, '
+        'sigma float not null, '
+        'games_count integer not null, '
+        'wins_count integer not null, '
+        'foreign key(ladder) references ladders(name), '
+        'primary key(ladder, game, player))',
+    )),
+    Migration('Index players by skill.', (
+        'create index if not exists players_by_mu on players (ladder, mu)',
+    )),
+    Migration('Index players by conservative skill.', (
+        'create index if not exists players_by_conservative '
+        'on players (ladder, mu - 3 * sigma)',
+    )),
+    Migration('Index games by ladder and id.', (
+        'create index if not exists games_by_ladder on games (ladder)',
+    )),
+    Migration('Index games by ladder and time.', (
+        'create index if not exists games_by_time '
+        'on games (ladder, timestamp)',
+    )),
+    Migration('Index participants by player.', (
+        'create index if not exists participants_by_player '
+        'on participants (player)',
+    )),
+    Migration('Index history by ladder and game.', (
+        'create index if not exists history_by_game on history (ladder, game)',
+    )),
+    Migration('Add the sequence of game ids.', (
+        'create table if not exists sequences ('
+        'name text primary key, '
+        'value integer not null)',
+        "insert or ignore into sequences (name, value) "
+        "select 'games', coalesce(max(id), 0) from games",
+    )),
+    Migration('Add the archive of compacted history.', (
+        'create table if not exists history_archive ('
+        'ladder text not null, '
+        'player text not null, '
+        'until integer not null, '
+        'last_game integer not null, '
+        'points blob not null, '
+        'foreign key(ladder) references ladders(name), '
+        'primary key(ladder, player))',
+    )),
+    Migration('Add the leases of rating recalculations.', (
+        'create table if not exists recalculations ('
+        'ladder text primary key, '
+        'until float not null default 0, '
+        'rewinds integer not null default 0, '
+        'foreign key(ladder) references ladders(name))',
+    )),
+    Migration('Key history by game instead of time.', (
+        'create table history_by_player ('
+        'ladder text not null, '
+        'player text not null, '
+        'timestamp integer not null, '
+        'mu float not null, '
+        'game integer, '
+        'sigma float, '
+        'foreign key(ladder) references ladders(name), '
+        'foreign key(player) references players(name), '
+        'primary key(ladder, player, game))',
+        'insert or ignore into history_by_player (ladder, player, timestamp, '
+        'mu, game, sigma) select ladder, player, timestamp, mu, game, sigma '
+        'from history',
+        'drop table history',
+        'alter table history_by_player rename to history',
+        'create index history_by_game on history (ladder, game)',
+    )),
+)
+
+
+def version(dbh: sqlite3.Connection) -> int:
+    """Return the schema version of the database."""
+    return dbh.execute('pragma user_version').fetchone()[0]
+
+
+def migrate(dbh: sqlite3.Connection) -> int:
+    """Apply the pending migrations, return how many were applied.
+
+    Several processes may migrate at once, each migration is applied by
+    the first one to take the write lock.
+    """
+    applied = 0
+    while version(dbh) < len(MIGRATIONS):
+        with dbh:  # Automatically commit/rollback.
+            dbh.execute('begin immediate')
+            current = version(dbh)
+            if current >= len(MIGRATIONS):
+                break
+            migration = MIGRATIONS[current]
+            if migration.column is None or migration.column[1] not in [
+                    row[1] for row in dbh.execute(
+                        'pragma table_info(%s)' % migration.column[0])]:
+                for statement in migration.statements:
+                    dbh.execute(statement)
+            dbh.execute('pragma user_version = %d' % (current + 1))
+        logging.info('Migrated to version %d: %s', current + 1,
+                     migration.description)
+        applied += 1
+    return applied
+
+
+def create(dbh: sqlite3.Connection) -> None:
+    """Create the schema in an empty database and bring it up to date."""
+    with open(SCHEMA) as schema:
+        dbh.executescript(schema.read())
+    migrate(dbh)
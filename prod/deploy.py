@@ -10,6 +10,11 @@ GIT_ROOT = "/home/ladders/git/ladders"
 WEB_ROOT = "/home/ladders/web"
 API_ROOT = "/home/ladders/api"
 UWSGI_MASTER_PIPE = "/tmp/ladders.master"
+API_MODULES = ("api.py", "caching.py", "compaction.py", "database.py",
+               "downsample.py", "export.py", "identity.py", "ingest.py",
+               "leaderboard.py", "matchmaking.py", "metrics.py",
+               "migrations.py", "ranking.py", "submissions.py", "suggest.py",
+               "vectorized.py")
 
 
 def main() -> None:
@@ -49,12 +54,15 @@ def deploy_web(build_number: int) -> None:
 
 
 def deploy_api(build_number: int) -> None:
-    """Move the old file away, new one in place and reload uwsgi."""
-    for basename in ("api.py", "ranking.py"):
+    """Move the old files away, new ones in place, migrate and reload uwsgi."""
+    for basename in API_MODULES:
         script = os.path.join(API_ROOT, basename)
         if os.path.exists(script):
             os.rename(script, script+"pre-%d" % build_number)
         shutil.copy2(os.path.join(GIT_ROOT, basename), script)
+    assert subprocess.run(
+        [os.path.join(API_ROOT, "env", "bin", "python"), "api.py", "migrate"],
+        cwd=API_ROOT).returncode == 0, "Migration failed."
     pipe = open(UWSGI_MASTER_PIPE, "w")
     pipe.write("r\n")
     pipe.close()
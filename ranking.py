@@ -1,11 +1,42 @@
 """Maintain ranking of a ladder."""
 
+import itertools
 import logging
 import sqlite3
-from typing import Any, Dict, List, Tuple
+import time
+from typing import (Any, Dict, Iterable, Iterator, List, NamedTuple, Optional,
+                    Set, Tuple)
 
+import numpy
 import trueskill
 
+import compaction
+import metrics
+from leaderboard import CONSERVATIVE
+from vectorized import PairwiseEngine
+
+# Every this many games all ratings of the ladder are saved, so that removing
+# a game only needs to replay the games after the preceding checkpoint.
+CHECKPOINT_INTERVAL = 1000
+# Number of the most recent checkpoints kept for each ladder.
+CHECKPOINTS_KEPT = 8
+# Upper bound on the number of games rated together by the vectorized engine.
+BATCH_SIZE = 1024
+# How long a recalculation may hold its ladder, in seconds. If its worker
+# dies, other workers take the ladder over after this long.
+LEASE = 60
+
+HistoryRow = Tuple[str, str, int, float, float, int]
+CheckpointRow = Tuple[str, int, str, float, float, int, int]
+
+
+class Game(NamedTuple):
+    """Outcome of a single game, as needed to rate it."""
+    id: int
+    timestamp: int
+    players: List[str]
+    positions: List[int]
+
 
 class Ranking(object):
     """A class to calculate ladder's ranking.
@@ -17,97 +48,423 @@ class Ranking(object):
         self.cursor = dbh.cursor()
         self.players: Dict[str, Player] = {}
         self.tsh: trueskill.TrueSkill = None
+        self.engine: Optional[PairwiseEngine] = None
         self.last_ranking = 0
+        self.last_game = 0
 
-    def standings(self) -> List[Any]:
-        """Return the list of players on the ladder sorted by skill."""
-        self.cursor.execute('select name, mu, games_count, wins_count '
+    def standings(self, conservative: bool = False, limit: int = -1,
+                  offset: int = 0) -> List[Any]:
+        """Return the list of players on the ladder sorted by skill.
+
+        Optionally sorted by the conservative skill, or just a page of them.
+        Either order is read from an index, so a page near the top doesn't
+        sort the whole ladder.
+        """
+        order = CONSERVATIVE if conservative else 'mu'
+        self.cursor.execute('select name, mu, sigma, games_count, wins_count '
                             'from players where ladder=? '
-                            'order by mu desc', [self.ladder])
+                            'order by ' + order + ' desc limit ? offset ?',
+                            [self.ladder, limit, offset])
         return self.cursor.fetchall()
 
     def recalculate(self) -> None:
-        """Update the ranking with all matches since last recalculate."""
-        self._get_ladder()
-        self.cursor.execute('select id, timestamp from games '
-                            'where ladder=? and timestamp>?',
-                            [self.ladder, self.last_ranking])
-        for game_id, timestamp in self.cursor.fetchall():
-            logging.info('Processing game %d at timestamp %d',
-                         game_id, timestamp)
-            logging.info('%d %d %s', timestamp, self.last_ranking,
-                         timestamp > self.last_ranking)
-            self.last_ranking = max(self.last_ranking, timestamp)
-            names, skills, positions = self._get_game(game_id)
-            new_ranks = self.tsh.rate(skills, ranks=positions)
-            for player, skill in zip(names, new_ranks):
-                self.players[player].rating = skill[0]
-                self._record_history(player, skill[0], timestamp)
-        self._update_ladder()
+        """Update the ranking with all matches since last recalculate.
+
+        Games are rated in the order of their ids, by one worker at a time.
+        """
+        while self._has_pending():
+            lease = self._claim()
+            if lease is None:
+                return
+            try:
+                with metrics.timed('ladders_recalculate_seconds',
+                                   ladder=self.ladder):
+                    self._replay()
+            finally:
+                self._release(lease)
+
+    def _replay(self) -> None:
+        """Rate the pending games and write the results, unless rewound."""
+        with self.dbh:  # Automatically commit/rollback.
+            self.dbh.execute('begin')
+            self._get_ladder()
+            rated = self._get_rated()
+            self._get_players()
+            history, checkpoints, changed, games_count = self._rate_pending(
+                self._games_since_checkpoint())
+        with self.dbh:  # Automatically commit/rollback.
+            self.dbh.execute('begin immediate')
+            if self._get_rated() == rated:
+                self._update_ladder(history, checkpoints, changed,
+                                    games_count)
+                return
+        logging.info('Ladder %s changed while recalculating, retrying.',
+                     self.ladder)
+
+    def _claim(self) -> Optional[float]:
+        """Take the lease of the ladder, None if another worker holds it.
+
+        The lease is identified by its expiry time. Once it expires, another
+        worker may take it over. The results of both workers are still
+        correct, as only the first one to write them keeps them.
+        """
+        now = time.time()
+        lease = now + LEASE
+        with self.dbh:  # Automatically commit/rollback.
+            self.dbh.execute('begin immediate')
+            self.cursor.execute('select until from recalculations '
+                                'where ladder=?', [self.ladder])
+            row = self.cursor.fetchone()
+            if row is not None and row[0] > now:
+                return None
+            self.cursor.execute('insert or ignore into recalculations '
+                                '(ladder) values (?)', [self.ladder])
+            self.cursor.execute('update recalculations set until=? '
+                                'where ladder=?', [lease, self.ladder])
+        return lease
+
+    def _release(self, lease: float) -> None:
+        """Give the lease up, unless it was taken over."""
+        with self.dbh:  # Automatically commit/rollback.
+            self.cursor.execute('update recalculations set until=0 '
+                                'where ladder=? and until=?',
+                                [self.ladder, lease])
+
+    def rebuild(self) -> int:
+        """Replay all games of the ladder from scratch.
+
+        Games are rated within a read transaction, which doesn't block other
+        writers, so that many ladders can be rebuilt at once. Results are
+        written by a short immediate transaction, after dropping all the
+        computed ratings. If the ratings were rewound meanwhile, the ladder
+        is rated again. Games added meanwhile are left to the next
+        recalculation. Returns the number of games rated.
+        """
+        while True:
+            with self.dbh:  # Automatically commit/rollback.
+                self.dbh.execute('begin')
+                rewinds = self._get_rated()[1]
+                self._get_ladder()
+                self.players = {}
+                self.last_game = self.last_ranking = 0
+                history, checkpoints, changed, games_count = (
+                    self._rate_pending(0))
+            with self.dbh:  # Automatically commit/rollback.
+                self.dbh.execute('begin immediate')
+                if self._get_rated()[1] == rewinds:
+                    self.reset()
+                    self._update_ladder(history, checkpoints, changed,
+                                        games_count)
+                    return games_count
+            logging.info('Ladder %s rewound while rebuilding, retrying.',
+                         self.ladder)
+
+    def _rate_pending(self, since_checkpoint: int
+                     ) -> Tuple[List[HistoryRow], List[CheckpointRow],
+                                Set[str], int]:
+        """Rate the games after `last_game` in memory.
+
+        Returns the history and checkpoint rows to be written, the names of
+        the players rated and the number of games.
+        """
+        history: List[HistoryRow] = []
+        checkpoints: List[CheckpointRow] = []
+        changed: Set[str] = set()
+        games_count = 0
+        # Unless replaying from scratch, the stored ratings of the players
+        # not loaded are current.
+        stored = self.last_game > 0
+        for batch in self._batches(self._pending_games()):
+            self._rate_batch(batch, history)
+            for game in batch:
+                changed.update(game.players)
+            games_count += len(batch)
+            since_checkpoint += len(batch)
+            if since_checkpoint >= CHECKPOINT_INTERVAL:
+                checkpoints.extend(self._checkpoint(stored))
+                since_checkpoint = 0
+        if games_count:
+            logging.info('Rated %d games of ladder %s.',
+                         games_count, self.ladder)
+        metrics.inc('ladders_rated_games_total', games_count, ladder=self.ladder)
+        metrics.inc('ladders_history_rows_total', len(history),
+                    ladder=self.ladder)
+        return history, checkpoints, changed, games_count
+
+    def rewind(self, game_id: int) -> None:
+        """Restore the ratings from before the given game.
+
+        The latest checkpoint preceding the game is restored and everything
+        computed after it is dropped, so that the next `recalculate` replays
+        only the later games. A recalculation in progress notices it by the
+        count of rewinds and starts over. Runs within the caller's
+        transaction.
+        """
+        self.cursor.execute('select coalesce(max(game), 0) from checkpoints '
+                            'where ladder=? and game<?', [self.ladder, game_id])
+        checkpoint = self.cursor.fetchone()[0]
+        self.cursor.execute('delete from checkpoints where ladder=? and game>?',
+                            [self.ladder, checkpoint])
+        if checkpoint:
+            self.cursor.execute('delete from history where ladder=? and game>?',
+                                [self.ladder, checkpoint])
+            compaction.trim(self.dbh, self.ladder, checkpoint)
+        else:
+            self.cursor.execute('delete from history where ladder=?',
+                                [self.ladder])
+            self.cursor.execute('delete from history_archive where ladder=?',
+                                [self.ladder])
+        self.cursor.execute('update players set '
+                            'mu=(select mu from ladders where name=?), '
+                            'sigma=(select sigma from ladders where name=?), '
+                            'games_count=0, wins_count=0 where ladder=?',
+                            [self.ladder, self.ladder, self.ladder])
+        self.cursor.execute('select mu, sigma, games_count, wins_count, player '
+                            'from checkpoints where ladder=? and game=?',
+                            [self.ladder, checkpoint])
+        restored = [tuple(row) + (self.ladder,)
+                    for row in self.cursor.fetchall()]
+        self.cursor.executemany('update players set mu=?, sigma=?, '
+                                'games_count=?, wins_count=? '
+                                'where name=? and ladder=?', restored)
+        self.cursor.execute('update ladders set last_game=?, last_ranking='
+                            '(select coalesce(max(timestamp), 0) from games '
+                            'where ladder=? and id<=?) where name=?',
+                            [checkpoint, self.ladder, checkpoint, self.ladder])
+        self.cursor.execute('insert or ignore into recalculations (ladder) '
+                            'values (?)', [self.ladder])
+        self.cursor.execute('update recalculations set rewinds = rewinds + 1 '
+                            'where ladder=?', [self.ladder])
+
+    def reset(self) -> None:
+        """Drop all the computed ratings, within the caller's transaction."""
+        self.rewind(0)
+
+    def _has_pending(self) -> bool:
+        """Check whether there are any games to be rated."""
+        self.cursor.execute('select exists (select 1 from games '
+                            'join ladders on ladders.name = games.ladder '
+                            'where games.ladder = ? '
+                            'and games.id > ladders.last_game)', [self.ladder])
+        return bool(self.cursor.fetchone()[0])
+
+    def _get_rated(self) -> Tuple[int, int]:
+        """Get the cursor of the last rated game and the count of rewinds."""
+        self.cursor.execute('select last_game, coalesce(rewinds, 0) '
+                            'from ladders left join recalculations '
+                            'on recalculations.ladder = ladders.name '
+                            'where name=?', [self.ladder])
+        row = self.cursor.fetchone()
+        return row[0], row[1]
 
     def _get_ladder(self) -> None:
-        """Get a TrueSkill object and the timestamp of the last game."""
-        self.cursor.execute('select mu, sigma, beta, tau, draw_probability, last_ranking '
+        """Get a TrueSkill object and the cursor of the last game."""
+        self.cursor.execute('select mu, sigma, beta, tau, draw_probability, '
+                            'last_ranking, last_game '
                             'from ladders where name = ?', [self.ladder])
         conf = self.cursor.fetchone()
         self.tsh = trueskill.TrueSkill(mu=conf['mu'], sigma=conf['sigma'],
                                        beta=conf['beta'], tau=conf['tau'],
                                        draw_probability=conf['draw_probability'])
+        self.engine = PairwiseEngine(self.tsh)
         self.last_ranking = conf['last_ranking']
+        self.last_game = conf['last_game']
+
+    def _get_players(self) -> None:
+        """Load the players of the games after `last_game`."""
+        self.cursor.execute('select name, mu, sigma, games_count, wins_count '
+                            'from players where ladder=? and name in '
+                            '(select participants.player from games '
+                            'join participants on participants.game = games.id '
+                            'where games.ladder=? and games.id>?)',
+                            [self.ladder, self.ladder, self.last_game])
+        self.players = {
+            row['name']: Player(row['name'],
+                                self.tsh.create_rating(row['mu'], row['sigma']),
+                                row['games_count'], row['wins_count'])
+            for row in self.cursor.fetchall()}
+
+    def _games_since_checkpoint(self) -> int:
+        """Count the games processed since the latest checkpoint."""
+        self.cursor.execute('select count(*) from games where ladder=? and id>'
+                            '(select coalesce(max(game), 0) from checkpoints '
+                            'where ladder=?) and id<=?',
+                            [self.ladder, self.ladder, self.last_game])
+        return self.cursor.fetchone()[0]
+
+    def _pending_games(self) -> Iterator[Game]:
+        """Stream the games after `last_game` along with their participants."""
+        cursor = self.dbh.execute(
+            'select games.id, games.timestamp, participants.player, '
+            'participants.position from games '
+            'join participants on participants.game = games.id '
+            'where games.ladder = ? and games.id > ? order by games.id',
+            [self.ladder, self.last_game])
+        for (game_id, timestamp), rows in itertools.groupby(
+                cursor, key=lambda row: (row[0], row[1])):
+            players, positions = [], []
+            for row in rows:
+                players.append(row[2])
+                positions.append(row[3])
+            yield Game(game_id, timestamp, players, positions)
+
+    @staticmethod
+    def _batches(games: Iterable[Game]) -> Iterator[List[Game]]:
+        """Group consecutive two-player games with disjoint players.
 
-    def _get_game(self, game_id: int)-> Tuple[List[str], List[List[float]], List[int]]:
-        self.cursor.execute('select player, position from participants '
-                            'where game = ?', [game_id])
-        names, skills, positions = [], [], []
-        for player, position in self.cursor.fetchall():
-            logging.info('%d: %s', position, player)
-            if player not in self.players:
-                self.players[player] = Player(player, self)
-                self.players[player].load(self.cursor)
-            names.append(player)
-            skills.append([self.players[player].rating])
-            positions.append(position)
-            self.players[player].games_count += 1
+        Such games don't depend on each other, so they can be rated together.
+        Any other game forms a batch of its own.
+        """
+        batch: List[Game] = []
+        seen: Set[str] = set()
+        for game in games:
+            if len(game.players) != 2:
+                if batch:
+                    yield batch
+                yield [game]
+                batch, seen = [], set()
+                continue
+            if seen.intersection(game.players) or len(batch) >= BATCH_SIZE:
+                yield batch
+                batch, seen = [], set()
+            batch.append(game)
+            seen.update(game.players)
+        if batch:
+            yield batch
+
+    def _rate_batch(self, batch: List[Game], history: List[HistoryRow]) -> None:
+        """Apply a batch of independent games and note the history rows."""
+        for game in batch:
+            for name in game.players:
+                if name not in self.players:
+                    self.players[name] = Player(name, self.tsh.create_rating())
+        if len(batch[0].players) < 2:
+            # Such games were accepted by old versions. They can't be rated,
+            # but must not hold back the games after them.
+            logging.warning('Game %d of ladder %s has a single player, '
+                            'skipped.', batch[0].id, self.ladder)
+            self.last_game = batch[0].id
+            return
+        if len(batch[0].players) == 2:
+            ratings = self._rate_pairs(batch)
+        else:
+            ratings = [None] * len(batch)
+        for game, new_ratings in zip(batch, ratings):
+            self._apply(game, new_ratings or self._rate(game), history)
+
+    def _rate(self, game: Game) -> List[trueskill.Rating]:
+        """Rate a single game by trueskill."""
+        skills = [[self.players[name].rating] for name in game.players]
+        new_ranks = self.tsh.rate(skills, ranks=game.positions)
+        return [skill[0] for skill in new_ranks]
+
+    def _rate_pairs(self, batch: List[Game]
+                   ) -> List[Optional[List[trueskill.Rating]]]:
+        """Rate independent two-player games by the vectorized engine.
+
+        Games the engine can't rate are left None, for trueskill.
+        """
+        if self.engine is None:
+            return [None] * len(batch)
+        # The engine wants the better placed player first.
+        swapped = [game.positions[0] > game.positions[1] for game in batch]
+        ratings = [[self.players[name].rating for name in game.players]
+                   for game in batch]
+        for pair, swap in zip(ratings, swapped):
+            if swap:
+                pair.reverse()
+        result = self.engine.rate(
+            numpy.array([[rating.mu for rating in pair] for pair in ratings]),
+            numpy.array([[rating.sigma for rating in pair]
+                         for pair in ratings]),
+            numpy.array([game.positions[0] == game.positions[1]
+                         for game in batch]))
+        new_ratings: List[Optional[List[trueskill.Rating]]] = []
+        for mus, sigmas, valid, swap in zip(
+                result[0].tolist(), result[1].tolist(), result[2].tolist(),
+                swapped):
+            if not valid:
+                new_ratings.append(None)
+                continue
+            pair = [self.tsh.create_rating(mu, sigma)
+                    for mu, sigma in zip(mus, sigmas)]
+            if swap:
+                pair.reverse()
+            new_ratings.append(pair)
+        return new_ratings
+
+    def _apply(self, game: Game, ratings: List[trueskill.Rating],
+               history: List[HistoryRow]) -> None:
+        """Store new ratings of the game's players, note the history rows."""
+        for name, position, rating in zip(game.players, game.positions,
+                                          ratings):
+            player = self.players[name]
+            player.rating = rating
+            player.games_count += 1
             if position == 0:
-                self.players[player].wins_count += 1
-        return names, skills, positions
+                player.wins_count += 1
+            history.append((self.ladder, name, game.timestamp, rating.mu,
+                            rating.sigma, game.id))
+        self.last_game = game.id
+        self.last_ranking = max(self.last_ranking, game.timestamp)
 
-    def _record_history(self, player: str, skill: trueskill.Rating, timestamp: int) -> None:
-        self.cursor.execute('insert into history (ladder, player, timestamp, '
-                            'mu) values (?,?,?,?)', [self.ladder, player, timestamp, skill.mu])
+    def _checkpoint(self, stored: bool) -> List[CheckpointRow]:
+        """Snapshot ratings of all players after the last processed game.
+
+        Players not loaded are taken from the players table if `stored`,
+        otherwise they are left out, as restoring keeps the initial rating.
+        """
+        rows = [(self.ladder, self.last_game, name) + player.row()
+                for name, player in self.players.items()]
+        if stored:
+            self.cursor.execute('select name, mu, sigma, games_count, '
+                                'wins_count from players where ladder=?',
+                                [self.ladder])
+            rows.extend((self.ladder, self.last_game) + tuple(row)
+                        for row in self.cursor if row[0] not in self.players)
+        return rows
+
+    def _update_ladder(self, history: List[HistoryRow],
+                       checkpoints: List[CheckpointRow],
+                       changed: Set[str], games_count: int) -> None:
+        """Update ladder with the newly computed ratings and last game."""
+        if games_count:
+            self.cursor.execute('update ladders set last_ranking = ?, '
+                                'last_game = ?, version = version + 1 '
+                                'where name = ?',
+                                [self.last_ranking, self.last_game,
+                                 self.ladder])
+        self.cursor.executemany('insert into history (ladder, '
+                                'player, timestamp, mu, sigma, game) '
+                                'values (?,?,?,?,?,?)', history)
+        self.cursor.executemany(
+            'update players set mu=?, sigma=?, games_count=?, '
+            'wins_count=? where name=? and ladder=?',
+            [self.players[name].row() + (name, self.ladder)
+             for name in changed])
+        if checkpoints:
+            self.cursor.executemany(
+                'insert into checkpoints (ladder, game, player, mu, sigma, '
+                'games_count, wins_count) values (?,?,?,?,?,?,?)',
+                checkpoints)
+            self.cursor.execute(
+                'delete from checkpoints where ladder=? and game not in '
+                '(select distinct game from checkpoints where ladder=? '
+                'order by game desc limit ?)',
+                [self.ladder, self.ladder, CHECKPOINTS_KEPT])
 
-    def _update_ladder(self) -> None:
-        """Update ladder with the newly computed ratings and last timestamp."""
-        with self.dbh:  # Automatically commit/rollback.
-            if self.last_ranking > 0:
-                self.cursor.execute('update ladders set last_ranking = ? '
-                                    'where name = ?', [self.last_ranking, self.ladder])
-            for name in self.players:
-                self.players[name].save(self.cursor)
 
 class Player(object):
     """Representation of ranking properties of a single player."""
 
-    def __init__(self, name: str, ranking: Ranking) -> None:
-        self.rating: trueskill.Rating = None
+    def __init__(self, name: str, rating: trueskill.Rating,
+                 games_count: int = 0, wins_count: int = 0) -> None:
+        self.rating = rating
         self.name = name
-        self.games_count = 0
-        self.wins_count = 0
-        self.ranking = ranking
-
-    def load(self, cursor: sqlite3.Cursor) -> None:
-        """Load the properties from the provided database cursor."""
-        cursor.execute('select mu, sigma, games_count, wins_count from players '
-                       'where name=? and ladder=?', [self.name, self.ranking.ladder])
-        loaded = cursor.fetchone()
-        logging.info('Fetched player %s skill %s', self.name, loaded['mu'])
-        self.rating = self.ranking.tsh.create_rating(loaded['mu'], loaded['sigma'])
-        self.games_count = loaded['games_count']
-        self.wins_count = loaded['wins_count']
-
-    def save(self, cursor: sqlite3.Cursor) -> None:
-        """Save the properties to the provided database cursor."""
-        cursor.execute('update players set mu=?, sigma=?, games_count=?, '
-                       'wins_count=? where name=? and ladder=?',
-                       [self.rating.mu, self.rating.sigma, self.games_count,
-                       self.wins_count, self.name, self.ranking.ladder])
+        self.games_count = games_count
+        self.wins_count = wins_count
+
+    def row(self) -> Tuple[float, float, int, int]:
+        """Return the (mu, sigma, games_count, wins_count) to be stored."""
+        return (self.rating.mu, self.rating.sigma, self.games_count,
+                self.wins_count)
@@ -0,0 +1,198 @@
+"""Group commit of submitted games."""
+
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+import database
+
+# Largest number of games written by one transaction.
+BATCH_SIZE = 256
+# How long the first game of a batch waits for others, in seconds.
+DELAY = float(os.environ.get('LADDERS_GROUP_COMMIT_DELAY', 5)) / 1000
+
+# Names of the players created in each ladder, with its roster version from
+# before they were.
+Created = Dict[str, Tuple[List[str], int]]
+
+
+class Submission(object):
+    """A game waiting in the queue."""
+
+    def __init__(self, ladder: str, outcome: List[List[str]],
+                 reporter_uid: Optional[str],
+                 reporter_ip: Optional[str]) -> None:
+        self.ladder = ladder
+        self.outcome = outcome
+        self.reporter_uid = reporter_uid
+        self.reporter_ip = reporter_ip
+        self.timestamp = int(time.time())
+        self.game_id: Optional[int] = None
+        self.error: Optional[Exception] = None
+        self.done = threading.Event()
+
+
+class SubmissionQueue(object):
+    """Write the submitted games in batches, by a thread of each process.
+
+    A batch is flushed once it has `batch_size` games, or `delay` seconds
+    after its first one. Its transaction commits with a full sync, so that
+    a game is durable by the time `submit` returns its id. Games are written
+    in the order they were queued, hence their ids keep the order of their
+    submission within each ladder.
+
+    After every commit `committed` is called with the writer's connection
+    and the players created, for every ladder touched. Its work is done by
+    the time the submitters are woken up.
+    """
+
+    def __init__(self, committed: Callable[[sqlite3.Connection, Created], None],
+                 batch_size: int = BATCH_SIZE, delay: float = DELAY) -> None:
+        self.committed = committed
+        self.batch_size = batch_size
+        self.delay = delay
+        self._queue: 'queue.Queue[Submission]' = queue.Queue()
+        self._lock = threading.Lock()
+        self._pid: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def submit(self, ladder: str, outcome: List[List[str]],
+               reporter_uid: Optional[str], reporter_ip: Optional[str]) -> int:
+        """Queue a game and return its id once it is committed."""
+        self._start()
+        submission = Submission(ladder, outcome, reporter_uid, reporter_ip)
+        self._queue.put(submission)
+        submission.done.wait()
+        if submission.error is not None:
+            raise submission.error
+        assert submission.game_id is not None
+        return submission.game_id
+
+    def _start(self) -> None:
+        """Start the writer, unless this process already has a live one.
+
+        Threads don't survive a fork, so the workers start their own writers
+        on their first submission. A writer that died is replaced, taking
+        over the games left in its queue.
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._queue = queue.Queue()
+            elif self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run,
+                                            args=(self._queue,), daemon=True)
+            self._thread.start()
+
+    def _run(self, games: 'queue.Queue[Submission]') -> None:
+        """Collect the queued games into batches and flush them."""
+        dbh: Optional[sqlite3.Connection] = None
+        while True:
+            batch = [games.get()]
+            deadline = time.monotonic() + self.delay
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(games.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                if dbh is None:
+                    dbh = database.connect()
+                    dbh.execute('pragma synchronous = full')
+            except Exception as exception:  # pylint: disable=broad-except
+                logging.exception('Group commit writer cannot connect.')
+                dbh = None
+                self._fail(batch, exception)
+                continue
+            try:
+                self._flush(dbh, batch)
+            except BaseException:
+                # The writer is dying, its submitters must not wait forever.
+                self._fail([submission for submission in batch
+                            if not submission.done.is_set()],
+                           RuntimeError('Group commit writer died.'))
+                raise
+
+    def _flush(self, dbh: sqlite3.Connection, batch: List[Submission]) -> None:
+        """Write a batch, then wake up its submitters.
+
+        If the batch fails, its games are retried one by one, so that only
+        the faulty ones report the error.
+        """
+        try:
+            created = self._write(dbh, batch)
+        except Exception as exception:  # pylint: disable=broad-except
+            if len(batch) > 1:
+                logging.warning('Batch of %d games failed, retrying one by '
+                                'one: %s', len(batch), exception)
+                for submission in batch:
+                    self._flush(dbh, [submission])
+                return
+            self._fail(batch, exception)
+            return
+        try:
+            self.committed(dbh, created)
+        except Exception:  # pylint: disable=broad-except
+            # The games are already committed, the submitters must know.
+            logging.exception('Post-commit work failed.')
+        for submission in batch:
+            submission.done.set()
+
+    @staticmethod
+    def _fail(batch: List[Submission], exception: Exception) -> None:
+        """Report an error to the submitters of a batch."""
+        for submission in batch:
+            submission.error = exception
+            submission.done.set()
+
+    @staticmethod
+    def _write(dbh: sqlite3.Connection, batch: List[Submission]) -> Created:
+        """Insert a batch of games in a single transaction."""
+        created: Created = {}
+        with dbh:  # Automatically commit/rollback.
+            dbh.execute('begin immediate')
+            cursor = dbh.cursor()
+            next_id = database.allocate_game_ids(cursor, len(batch))
+            participants = []
+            for game_id, submission in enumerate(batch, next_id):
+                ladder = submission.ladder
+                cursor.execute('insert into games (id, ladder, timestamp, '
+                               'reporter_uid, reporter_ip) values (?,?,?,?,?)',
+                               [game_id, ladder, submission.timestamp,
+                                submission.reporter_uid,
+                                submission.reporter_ip])
+                names = created.setdefault(ladder, ([], 0))[0]
+                for position, members in enumerate(submission.outcome):
+                    for name in members:
+                        cursor.execute('insert or ignore into players '
+                                       '(name, ladder, mu, sigma) '
+                                       'select ?, name, mu, sigma '
+                                       'from ladders where name=?',
+                                       [name, ladder])
+                        if cursor.rowcount:
+                            names.append(name)
+                        participants.append((game_id, name, position))
+            cursor.executemany('insert into participants '
+                               '(game, player, position) values (?, ?, ?)',
+                               participants)
+            for ladder, (names, _) in list(created.items()):
+                cursor.execute('update ladders set version = version + 1 '
+                               'where name = ?', [ladder])
+                if names:
+                    cursor.execute('select roster_version from ladders '
+                                   'where name = ?', [ladder])
+                    created[ladder] = (names, cursor.fetchone()[0])
+                    cursor.execute('update ladders set roster_version = '
+                                   'roster_version + 1 where name = ?',
+                                   [ladder])
+        for game_id, submission in enumerate(batch, next_id):
+            submission.game_id = game_id
+        return created
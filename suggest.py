@@ -0,0 +1,102 @@
+"""In-memory prefix index of player names for autocompletion."""
+
+import bisect
+import sqlite3
+import time
+from typing import Dict, Iterable, List, Tuple
+
+from caching import LRUCache
+
+# Number of names suggested for a prefix.
+SUGGESTIONS = 10
+# Indexes are rebuilt after this many seconds to pick up new games counts.
+MAX_AGE = 300
+
+
+class _Node(object):
+    """Node of the trie, with the best ranked names below it."""
+    __slots__ = ('children', 'top')
+
+    def __init__(self) -> None:
+        self.children: Dict[str, _Node] = {}
+        self.top: List[Tuple[int, str]] = []
+
+
+class PrefixIndex(object):
+    """Trie of player names of a ladder.
+
+    Every node keeps the best ranked names starting with its prefix, so a
+    lookup only walks the prefix, regardless of the number of players.
+    Names are ranked by their number of games and matched case-insensitively
+    like SQLite's LIKE does.
+    """
+
+    def __init__(self, roster_version: int) -> None:
+        self.roster_version = roster_version
+        self.built = time.time()
+        self.root = _Node()
+        self.names: Dict[str, int] = {}
+
+    def add(self, name: str, games_count: int = 0) -> None:
+        """Add a player to the index."""
+        if name in self.names:
+            return
+        self.names[name] = games_count
+        key = (-games_count, name)
+        node = self.root
+        self._offer(node, key)
+        for char in name.lower():
+            node = node.children.setdefault(char, _Node())
+            self._offer(node, key)
+
+    def suggest(self, prefix: str) -> List[str]:
+        """Return the best ranked names starting with the prefix."""
+        node = self.root
+        for char in prefix.lower():
+            child = node.children.get(char)
+            if child is None:
+                return []
+            node = child
+        return [name for _, name in node.top]
+
+    @staticmethod
+    def _offer(node: _Node, key: Tuple[int, str]) -> None:
+        bisect.insort(node.top, key)
+        if len(node.top) > SUGGESTIONS:
+            node.top.pop()
+
+
+class SuggestionIndex(object):
+    """Prefix indexes of ladders, built lazily and kept up to date.
+
+    An index is valid for the ladder's roster version, which changes whenever
+    players are created or removed. The worker making the change updates its
+    own index in place, the others rebuild theirs on the next lookup.
+    """
+
+    def __init__(self, max_ladders: int = 256) -> None:
+        self.indexes = LRUCache(max_ladders)
+
+    def suggest(self, dbh: sqlite3.Connection, ladder: str,
+                roster_version: int, prefix: str) -> List[str]:
+        """Return the best ranked names of the ladder starting with prefix."""
+        index = self.indexes.get(ladder)
+        if (index is None or index.roster_version != roster_version or
+                time.time() - index.built > MAX_AGE):
+            index = PrefixIndex(roster_version)
+            for name, games_count in dbh.execute(
+                    'select name, games_count from players where ladder=?',
+                    [ladder]):
+                index.add(name, games_count)
+            self.indexes.put(ladder, index)
+        return index.suggest(prefix)
+
+    def added(self, ladder: str, names: Iterable[str],
+              roster_version: int) -> None:
+        """Note new players, which moved the roster past the given version."""
+        index = self.indexes.get(ladder)
+        if index is None or index.roster_version != roster_version:
+            return
+        for name in names:
+            index.add(name)
+        index.roster_version = roster_version + 1
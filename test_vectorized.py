@@ -0,0 +1,93 @@
+"""Parity of the vectorized engine with trueskill."""
+
+import random
+import sqlite3
+
+import numpy
+import pytest
+import trueskill
+
+from ranking import Game, Player, Ranking
+from vectorized import PairwiseEngine
+
+TOLERANCE = 1e-9
+
+
+def make_tsh(draw_probability: float) -> trueskill.TrueSkill:
+    return trueskill.TrueSkill(mu=1200, sigma=400, beta=200, tau=4,
+                               draw_probability=draw_probability)
+
+
+@pytest.mark.parametrize('draw_probability', [0, 0.1, 0.3])
+def test_rate_matches_trueskill(draw_probability):
+    rnd = random.Random(1)
+    tsh = make_tsh(draw_probability)
+    pairs, draws = [], []
+    for _ in range(500):
+        pairs.append([tsh.create_rating(rnd.gauss(1200, 300),
+                                        rnd.uniform(20, 400))
+                      for _ in range(2)])
+        draws.append(rnd.random() < .3)
+    new_mu, new_sigma, valid = PairwiseEngine(tsh).rate(
+        numpy.array([[rating.mu for rating in pair] for pair in pairs]),
+        numpy.array([[rating.sigma for rating in pair] for pair in pairs]),
+        numpy.array(draws))
+    # Draws are impossible without the draw margin.
+    assert list(valid) == [draw_probability > 0 or not draw for draw in draws]
+    for pair, draw, mus, sigmas, is_valid in zip(pairs, draws, new_mu,
+                                                 new_sigma, valid):
+        if not is_valid:
+            continue
+        expected = tsh.rate([[rating] for rating in pair],
+                            ranks=[0, 0 if draw else 1])
+        for (rating,), mu, sigma in zip(expected, mus, sigmas):
+            assert abs(rating.mu - mu) < TOLERANCE
+            assert abs(rating.sigma - sigma) < TOLERANCE
+
+
+def make_ranking(draw_probability: float, seed: int) -> Ranking:
+    rnd = random.Random(seed)
+    ranking = Ranking('test', sqlite3.connect(':memory:'))
+    ranking.tsh = make_tsh(draw_probability)
+    ranking.engine = PairwiseEngine(ranking.tsh)
+    for number in range(100):
+        name = 'p%d' % number
+        ranking.players[name] = Player(name, ranking.tsh.create_rating(
+            rnd.gauss(1200, 300), rnd.uniform(20, 400)))
+    return ranking
+
+
+@pytest.mark.parametrize('positions', [[0, 1], [1, 0], [0, 0]])
+def test_rate_pairs_matches_rate(positions):
+    ranking = make_ranking(0.1, 2)
+    batch = [Game(number + 1, 0, ['p%d' % (2 * number),
+                                  'p%d' % (2 * number + 1)], positions)
+             for number in range(50)]
+    new_ratings = ranking._rate_pairs(batch)  # pylint: disable=protected-access
+    for game, pair in zip(batch, new_ratings):
+        assert pair is not None
+        expected = ranking._rate(game)  # pylint: disable=protected-access
+        for rating, new_rating in zip(expected, pair):
+            assert abs(rating.mu - new_rating.mu) < TOLERANCE
+            assert abs(rating.sigma - new_rating.sigma) < TOLERANCE
+
+
+def test_rate_batch_falls_back_per_game():
+    ranking = make_ranking(0, 3)
+    batch = [Game(number + 1, 0, ['p%d' % (2 * number),
+                                  'p%d' % (2 * number + 1)],
+                  [0, 0 if number % 3 == 0 else 1])
+             for number in range(50)]
+    # The draws are left to trueskill, the wins still rated by the engine.
+    pairs = ranking._rate_pairs(batch)  # pylint: disable=protected-access
+    assert [pair is None for pair in pairs] == [
+        game.positions == [0, 0] for game in batch]
+    expected = {}
+    for game in batch:
+        ratings = ranking._rate(game)  # pylint: disable=protected-access
+        expected.update(zip(game.players, ratings))
+    ranking._rate_batch(batch, [])  # pylint: disable=protected-access
+    for name, rating in expected.items():
+        new_rating = ranking.players[name].rating
+        assert abs(rating.mu - new_rating.mu) < TOLERANCE
+        assert abs(rating.sigma - new_rating.sigma) < TOLERANCE
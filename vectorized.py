@@ -0,0 +1,93 @@
+"""Closed-form TrueSkill updates of two-player games, vectorized by NumPy.
+
+The factor graph of `trueskill` is exact, but slow in pure Python. For a game
+of just two participants it reduces to a closed form, which is applied here
+to whole batches of games at once. The normal distribution functions follow
+the default backend of `trueskill`, so that the results match closely.
+"""
+
+import math
+from typing import Tuple
+
+import numpy
+import trueskill
+
+# Narrowest draw margin, relative to the performance deviation, for which
+# draws are rated here. Narrower ones lose precision to cancellation.
+MIN_DRAW_MARGIN = 1e-3
+
+
+def erfc(x: numpy.ndarray) -> numpy.ndarray:
+    """Complementary error function, the approximation used by trueskill."""
+    z = numpy.abs(x)
+    t = 1. / (1. + z / 2.)
+    r = t * numpy.exp(-z * z - 1.26551223 + t * (1.00002368 + t * (
+        0.37409196 + t * (0.09678418 + t * (-0.18628806 + t * (
+            0.27886807 + t * (-1.13520398 + t * (1.48851587 + t * (
+                -0.82215223 + t * 0.17087277
+            )))
+        )))
+    )))
+    return numpy.where(x < 0, 2. - r, r)
+
+
+def cdf(x: numpy.ndarray) -> numpy.ndarray:
+    """Cumulative distribution function of the standard normal."""
+    return 0.5 * erfc(-x / math.sqrt(2))
+
+
+def pdf(x: numpy.ndarray) -> numpy.ndarray:
+    """Probability density function of the standard normal."""
+    return numpy.exp(-x ** 2 / 2) / math.sqrt(2 * math.pi)
+
+
+class PairwiseEngine(object):
+    """Rate batches of independent two-player games at once."""
+
+    def __init__(self, tsh: trueskill.TrueSkill) -> None:
+        self.beta = tsh.beta
+        self.tau = tsh.tau
+        self.draw_margin = trueskill.calc_draw_margin(
+            tsh.draw_probability, 2, env=tsh)
+
+    def rate(self, mu: numpy.ndarray, sigma: numpy.ndarray,
+             draws: numpy.ndarray
+            ) -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+        """Return new (mu, sigma) of players of the games, and which are valid.
+
+        Arrays `mu` and `sigma` have a row per game, the better placed player
+        of the game first. The update is valid unless numerically unstable,
+        such as for a draw with zero or tiny draw probability. Such games
+        are left to trueskill.
+        """
+        with numpy.errstate(all='ignore'):
+            variance = sigma ** 2 + self.tau ** 2
+            c = numpy.sqrt(variance.sum(axis=1) + 2 * self.beta ** 2)
+            diff = (mu[:, 0] - mu[:, 1]) / c
+            margin = self.draw_margin / c
+            v, w = numpy.where(draws, self._v_w_draw(diff, margin),
+                               self._v_w_win(diff, margin))
+            sign = numpy.array([1., -1.])
+            new_mu = mu + sign * variance / c[:, None] * v[:, None]
+            new_sigma = numpy.sqrt(
+                variance * (1 - variance / (c ** 2)[:, None] * w[:, None]))
+        valid = ((w > 0) & (w < 1) & (~draws | (margin >= MIN_DRAW_MARGIN)) &
+                 numpy.isfinite(new_mu).all(axis=1) &
+                 numpy.isfinite(new_sigma).all(axis=1))
+        return new_mu, new_sigma, valid
+
+    @staticmethod
+    def _v_w_win(diff: numpy.ndarray, margin: numpy.ndarray) -> numpy.ndarray:
+        x = diff - margin
+        denom = cdf(x)
+        v = numpy.where(denom != 0, pdf(x) / denom, -x)
+        return numpy.stack([v, v * (v + x)])
+
+    @staticmethod
+    def _v_w_draw(diff: numpy.ndarray, margin: numpy.ndarray) -> numpy.ndarray:
+        abs_diff = numpy.abs(diff)
+        a, b = margin - abs_diff, -margin - abs_diff
+        denom = cdf(a) - cdf(b)
+        v = numpy.where(denom != 0, (pdf(b) - pdf(a)) / denom, a)
+        w = v ** 2 + (a * pdf(a) - b * pdf(b)) / denom
+        return numpy.stack([numpy.where(diff < 0, -v, v), w])